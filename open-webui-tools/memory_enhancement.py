@@ -34,11 +34,31 @@ Thanks to https://github.com/soymh and https://github.com/CookSleep for the
 foundational memory tool implementation patterns.
 """
 
+import asyncio
+import bisect
+import copy
+import functools
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Callable, Any, List, Optional, Dict
+from typing import Callable, Any, List, Optional, Dict, Set, Tuple
 from pydantic import BaseModel, Field
 
+log = logging.getLogger(__name__)
+
 # Open WebUI internal imports for memory access
 try:
     from open_webui.models.memories import Memories
@@ -46,6 +66,1382 @@ try:
 except ImportError:
     MEMORIES_AVAILABLE = False
 
+# Open WebUI ORM access for batched writes (falls back to per-memory calls)
+try:
+    from open_webui.internal.db import get_db
+    from open_webui.models.memories import Memory, MemoryModel
+    BATCH_DB_AVAILABLE = True
+except ImportError:
+    BATCH_DB_AVAILABLE = False
+
+# Faster JSON backend (falls back to the standard library)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Optional NumPy support for the vector search mode
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+# Word runs and single punctuation marks, for local token estimates
+_APPROX_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# Function words (and "user", which nearly every memory mentions) that carry no topic
+_STOPWORDS = frozenset((
+    "a about after all also am an and any are as at be been before but by can could did do does for from had "
+    "has have he her him his how i if in into is it its me my no not of on or our she should so than that the "
+    "their them then there these they this those to up us was we were what when where which who why will with "
+    "would you your s user users"
+).split())
+_MAX_MEMORY_LENGTH = 1000
+# Leading "[CATEGORY]" or "[CATEGORY:detail]" tag written by this tool
+_CATEGORY_PATTERN = re.compile(r"^\[([A-Za-z0-9_ -]+?)(?::[^\]]*)?\]\s*")
+# Pieces of the "[CONTEXT:...]" memories written by commit_context_to_memory
+_CONTEXT_HEADER_PATTERN = re.compile(
+    r"^\[CONTEXT:([^\]]*)\]\s*(.*?)(?: \(consolidated from (\d+) snapshots(?:, part (\d+))?\))?$"
+)
+_CONTEXT_ENTITY_PATTERN = re.compile(r"^\s*- (\w+) \(([^)]*)\): (.*)$")
+# Structured search_memories filters: category:/before:/after: and "quoted phrases"
+_SEARCH_FILTER_PATTERN = re.compile(r'\b(category|before|after):("[^"]*"|\S+)|"([^"]*)"', re.IGNORECASE)
+
+
+def _tokenize(text: str) -> List[str]:
+    """Split text into lowercase word tokens used for indexing and querying."""
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def _estimate_tokens(text: str) -> int:
+    """Approximate LLM token count: about one token per 4 characters of a word, one per punctuation mark."""
+    return sum((len(piece) + 3) // 4 for piece in _APPROX_TOKEN_PATTERN.findall(text))
+
+
+def _summarize_memory(content: str, max_words: int = 12) -> str:
+    """Summary-only form of a memory: the first words of its first line."""
+    lines = content.strip().splitlines()
+    words = lines[0].split() if lines else []
+    shortened = len(words) > max_words or len(lines) > 1
+    return " ".join(words[:max_words]) + (" …" if shortened else "")
+
+
+def _pack_to_budget(
+    entries: List[Tuple[str, str]], max_tokens: int, overhead: int = 0, stop_at_overflow: bool = False
+) -> List[Tuple[int, str]]:
+    """
+    Greedily fit (full, summary) text pairs, in priority order, into a token budget.
+
+    Each entry is kept in full if it fits, else as its summary if that fits,
+    else dropped; with `stop_at_overflow` packing stops there instead, so
+    ordered pages stay contiguous. `overhead` is the per-entry cost of the
+    numbering and IDs around the text. Returns (entry index, text) pairs.
+    """
+    packed = []
+    remaining = max_tokens
+    for position, (full, summary) in enumerate(entries):
+        for text in (full, summary):
+            cost = _estimate_tokens(text) + overhead
+            if cost <= remaining:
+                packed.append((position, text))
+                remaining -= cost
+                break
+        else:
+            if stop_at_overflow:
+                break
+    return packed
+
+
+def _format_memory_content(content: str, category: Optional[str] = None) -> str:
+    """Truncate memory content and add the optional [CATEGORY] prefix."""
+    content = content[:_MAX_MEMORY_LENGTH]
+    return f"[{category.upper()}] {content}" if category else content
+
+
+def _memory_category(content: str) -> Optional[str]:
+    """Return the upper-cased category tag of a memory, if it has one."""
+    match = _CATEGORY_PATTERN.match(content)
+    return match.group(1).upper() if match else None
+
+
+def _parse_timestamp(value: str) -> float:
+    """Parse an ISO-8601 date or datetime into epoch seconds (raises ValueError)."""
+    return datetime.fromisoformat(value.strip()).timestamp()
+
+
+class _SearchQuery:
+    """
+    A search_memories query compiled into free text and structured filters.
+
+    `category:NAME` (repeatable; any of them matches), `before:DATE`,
+    `after:DATE` and "quoted phrases" (all must appear verbatim) are split
+    out once per query; the remaining text plus the phrase words is what
+    gets scored. Raises ValueError for an unparseable date.
+    """
+
+    __slots__ = ("text", "categories", "before", "after", "phrases")
+
+    def __init__(self, query: str):
+        self.categories: Set[str] = set()
+        self.before: Optional[float] = None
+        self.after: Optional[float] = None
+        self.phrases: List[str] = []
+        self.text = " ".join(_SEARCH_FILTER_PATTERN.sub(self._take, query).split())
+
+    @classmethod
+    def plain(cls, text: str) -> "_SearchQuery":
+        """A query of free text only, with no filter syntax interpreted."""
+        search = cls("")
+        search.text = " ".join(text.split())
+        return search
+
+    def _take(self, match: Any) -> str:
+        key, value, phrase = match.groups()
+        if phrase is not None:
+            if phrase.strip():
+                self.phrases.append(phrase.strip().lower())
+            return f" {phrase} "
+        key, value = key.lower(), value.strip('"')
+        if key == "category":
+            self.categories.add(value.strip("[] ").upper())
+            return " "
+        try:
+            timestamp = _parse_timestamp(value)
+        except ValueError:
+            raise ValueError(f"Invalid date '{value}' in the {key}: filter. Use ISO format, e.g. 2026-01-31.")
+        if key == "before":
+            self.before = timestamp
+        else:
+            self.after = timestamp
+        return " "
+
+
+def _insert_memory_batch(user_id: str, contents: List[str]) -> List[Any]:
+    """
+    Insert several memories for a user, in a single transaction when possible.
+
+    Uses Open WebUI's ORM session directly when available, otherwise falls back
+    to one Memories.insert_new_memory call per item. Blocking; run it on the
+    database thread pool.
+    """
+    if not BATCH_DB_AVAILABLE:
+        return [memory for memory in (Memories.insert_new_memory(user_id, c) for c in contents) if memory]
+    now = int(time.time())
+    models = [
+        MemoryModel(id=str(uuid.uuid4()), user_id=user_id, content=content, created_at=now, updated_at=now)
+        for content in contents
+    ]
+    with get_db() as db:
+        db.add_all([Memory(**model.model_dump()) for model in models])
+        db.commit()
+    return models
+
+
+def _update_memory_batch(user_id: str, changes: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Apply {memory_id: new_content} changes, in a single transaction when possible.
+
+    Returns the updated memories keyed by id; ids that were not found are
+    absent. Blocking; run it on the database thread pool.
+    """
+    if not BATCH_DB_AVAILABLE:
+        updated = {memory_id: Memories.update_memory_by_id(memory_id, content) for memory_id, content in changes.items()}
+        return {memory_id: memory for memory_id, memory in updated.items() if memory}
+    now = int(time.time())
+    with get_db() as db:
+        rows = db.query(Memory).filter(Memory.user_id == user_id, Memory.id.in_(list(changes))).all()
+        for row in rows:
+            row.content = changes[row.id]
+            row.updated_at = now
+        db.commit()
+        return {row.id: MemoryModel.model_validate(row) for row in rows}
+
+
+def _delete_memory_batch(user_id: str, memory_ids: List[str]) -> Set[str]:
+    """
+    Delete the given memories of a user, in a single transaction when possible.
+
+    Returns the ids that were actually deleted. Blocking; run it on the
+    database thread pool.
+    """
+    if not BATCH_DB_AVAILABLE:
+        return {memory_id for memory_id in memory_ids if Memories.delete_memory_by_id_and_user_id(memory_id, user_id)}
+    with get_db() as db:
+        query = db.query(Memory).filter(Memory.user_id == user_id, Memory.id.in_(memory_ids))
+        deleted = {row.id for row in query.with_entities(Memory.id).all()}
+        query.delete(synchronize_session=False)
+        db.commit()
+    return deleted
+
+
+def _plan_context_consolidation(memories: List[Any], max_length: int = _MAX_MEMORY_LENGTH) -> List[Tuple[List[Any], List[str]]]:
+    """
+    Plan how to compact "[CONTEXT:...]" snapshots into consolidated memories.
+
+    Snapshots are grouped by their Task line; each group with more than one
+    snapshot becomes (memories newest first, consolidated contents). The
+    consolidated contents keep the newest header and summary and the latest
+    value of every entity seen in the group, split into as few memories of at
+    most `max_length` characters as possible. Only the first part records the
+    snapshot count, so consolidating again never double counts. Groups that
+    would not shrink (e.g. parts of an earlier consolidation with no newer
+    snapshot) are left alone.
+    """
+    groups: Dict[str, List[Any]] = {}
+    for memory in sorted(memories, key=lambda memory: memory.created_at):
+        lines = memory.content.splitlines()
+        if not lines or not _CONTEXT_HEADER_PATTERN.match(lines[0]):
+            continue
+        task = next((line[len("Task: "):] for line in lines[1:] if line.startswith("Task: ")), "")
+        groups.setdefault(task, []).append(memory)
+
+    plans = []
+    for task, group in groups.items():
+        if len(group) < 2:
+            continue
+        headers = [_CONTEXT_HEADER_PATTERN.match(memory.content.splitlines()[0]).groups() for memory in group]
+        if all(count is not None for _, _, count, _ in headers) and len({header[:3] for header in headers}) == 1:
+            # Parts of one earlier consolidation and nothing newer
+            continue
+        latest: Dict[str, str] = {}
+        snapshots = 0
+        for memory, (_, _, count, part) in zip(group, headers):
+            if part is None:
+                snapshots += int(count or 1)
+            for line in memory.content.splitlines()[1:]:
+                match = _CONTEXT_ENTITY_PATTERN.match(line)
+                if match:
+                    latest[match.group(1)] = line
+        timestamp, summary, _, _ = headers[-1]
+        title = f"[CONTEXT:{timestamp}] {summary} (consolidated from {snapshots} snapshots"
+        body = f"\nTask: {task}\nEntities:\n"
+        chunks: List[List[str]] = [[]]
+        size = len(title) + len(body) + 1
+        for line in latest.values():
+            if chunks[-1] and size + len(line) + 1 > max_length:
+                chunks.append([])
+                size = len(title) + len(body) + 1 + len(", part 10")
+            chunks[-1].append(line)
+            size += len(line) + 1
+        if len(chunks) >= len(group):
+            # Splitting would not reduce the number of memories
+            continue
+        contents = [
+            title + (f", part {number}" if number > 1 else "") + ")" + body + "".join(line + "\n" for line in chunk)
+            for number, chunk in enumerate(chunks, 1)
+        ]
+        plans.append((group[::-1], contents))
+    return plans
+
+
+class _MemoryIndex:
+    """
+    Per-user inverted index over memory content with BM25 ranking.
+
+    Maps every term to the posting list of memory ids that contain it (with
+    term frequencies), so a search only touches memories sharing at least one
+    term with the query instead of scanning the whole bank. Document lengths
+    and the total corpus length are maintained incrementally on every add and
+    remove; document frequencies are the posting list sizes.
+    """
+
+    def __init__(self):
+        self.memories: Dict[str, Any] = {}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+
+    def add(self, memory: Any) -> None:
+        """Index a memory, replacing any previously indexed version."""
+        if memory.id in self.memories:
+            self.remove(memory.id)
+        terms = _tokenize(memory.content)
+        frequencies: Dict[str, int] = {}
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+        self.memories[memory.id] = memory
+        self.doc_lengths[memory.id] = len(terms)
+        self.total_length += len(terms)
+        for term, tf in frequencies.items():
+            self.postings.setdefault(term, {})[memory.id] = tf
+
+    def remove(self, memory_id: str) -> None:
+        """Drop a memory, its postings and its length statistics from the index."""
+        memory = self.memories.pop(memory_id, None)
+        if memory is None:
+            return
+        self.total_length -= self.doc_lengths.pop(memory_id, 0)
+        for term in set(_tokenize(memory.content)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.pop(memory_id, None)
+            if not posting:
+                del self.postings[term]
+
+    def containing(self, terms: Set[str]) -> Set[str]:
+        """Ids of memories that contain every one of the terms."""
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+        if not postings:
+            return set(self.memories)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            found.intersection_update(posting)
+        return found
+
+    def search(
+        self, query: str, count: int, k1: float = 1.2, b: float = 0.75, allowed: Optional[Set[str]] = None
+    ) -> List[Tuple[float, Any]]:
+        """Return up to `count` (score, memory) pairs ranked by BM25 relevance, optionally only among `allowed` ids."""
+        total_docs = len(self.memories)
+        if not total_docs:
+            return []
+        avg_length = self.total_length / total_docs or 1.0
+        scores: Dict[str, float] = {}
+        # Stopwords alone would make almost every memory a weak match
+        for term in set(_tokenize(query)) - _STOPWORDS:
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (total_docs - df + 0.5) / (df + 0.5))
+            if allowed is None:
+                matches = posting.items()
+            elif len(allowed) < df:
+                matches = [(memory_id, posting[memory_id]) for memory_id in allowed if memory_id in posting]
+            else:
+                matches = [(memory_id, tf) for memory_id, tf in posting.items() if memory_id in allowed]
+            for memory_id, tf in matches:
+                norm = k1 * (1 - b + b * self.doc_lengths[memory_id] / avg_length)
+                scores[memory_id] = scores.get(memory_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+        top = heapq.nlargest(count, scores.items(), key=lambda item: item[1])
+        return [(score, self.memories[memory_id]) for memory_id, score in top]
+
+
+class _HashingEmbedder:
+    """
+    Offline embedder based on signed feature hashing.
+
+    Words and character trigrams are hashed into a fixed number of dimensions
+    and the result is L2-normalized, so dot products are cosine similarities.
+    Stopwords are skipped; otherwise they and their trigrams dominate the
+    score and make unrelated sentences look alike.
+    Needs no network, GPU or model download. Any object with a `dim` attribute
+    and an `embed(text)` method returning a float32 vector can replace it.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def embed(self, text: str) -> "np.ndarray":
+        """Embed text into a unit-length float32 vector."""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in _tokenize(text):
+            if token in _STOPWORDS:
+                continue
+            features = [token]
+            padded = f"#{token}#"
+            features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+            for feature in features:
+                digest = zlib.crc32(feature.encode("utf-8"))
+                vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = float(np.linalg.norm(vector))
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class _VectorIndex:
+    """
+    Per-user embedding matrix for semantic memory search.
+
+    All embeddings live in one contiguous float32 matrix, so a query is a
+    single matrix-vector product followed by an argpartition top-k. Rows are
+    overwritten in place on update and recycled after deletion; the matrix
+    only grows (by doubling) when no free row is left.
+    """
+
+    def __init__(self, embedder: Any, capacity: int = 64):
+        self.embedder = embedder
+        self.matrix = np.zeros((capacity, embedder.dim), dtype=np.float32)
+        self.row_memories: List[Optional[Any]] = []
+        self.rows: Dict[str, int] = {}
+        self.free_rows: List[int] = []
+
+    def add(self, memory: Any) -> None:
+        """Embed a memory into its existing row, a recycled row, or a new row."""
+        row = self.rows.get(memory.id)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+                self.row_memories[row] = memory
+            else:
+                row = len(self.row_memories)
+                if row >= self.matrix.shape[0]:
+                    grown = np.zeros((self.matrix.shape[0] * 2, self.matrix.shape[1]), dtype=np.float32)
+                    grown[:row] = self.matrix[:row]
+                    self.matrix = grown
+                self.row_memories.append(memory)
+            self.rows[memory.id] = row
+        else:
+            self.row_memories[row] = memory
+        self.matrix[row] = self.embedder.embed(memory.content)
+
+    def remove(self, memory_id: str) -> None:
+        """Clear a memory's row and mark it for reuse."""
+        row = self.rows.pop(memory_id, None)
+        if row is None:
+            return
+        self.matrix[row] = 0.0
+        self.row_memories[row] = None
+        self.free_rows.append(row)
+
+    def search(
+        self, query: str, count: int, allowed: Optional[Set[str]] = None, min_similarity: float = 0.0
+    ) -> List[Tuple[float, Any]]:
+        """
+        Return up to `count` (similarity, memory) pairs with cosine similarity above `min_similarity`.
+
+        With `allowed`, only those memories' rows are scored.
+        """
+        if allowed is None:
+            rows = None
+            count = min(count, len(self.rows))
+        else:
+            rows = np.fromiter((self.rows[memory_id] for memory_id in allowed if memory_id in self.rows), dtype=np.intp)
+            count = min(count, len(rows))
+        if count <= 0:
+            return []
+        query_vector = self.embedder.embed(query)
+        if rows is None:
+            scores = self.matrix[:len(self.row_memories)] @ query_vector
+            if self.free_rows:
+                scores[self.free_rows] = -np.inf
+        else:
+            scores = self.matrix[rows] @ query_vector
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (float(scores[i]), self.row_memories[i if rows is None else rows[i]])
+            for i in top if scores[i] > max(min_similarity, 0.0)
+        ]
+
+
+def _reciprocal_rank_fusion(
+    rankings: List[Tuple[float, List[Tuple[float, Any]]]], k: int, count: int
+) -> List[Tuple[float, Any]]:
+    """
+    Fuse several ranked result lists with weighted reciprocal rank fusion.
+
+    Each entry of `rankings` is a (weight, results) pair; a memory scores
+    weight / (k + rank) for every list it appears in.
+    """
+    fused: Dict[str, float] = {}
+    memories: Dict[str, Any] = {}
+    for weight, results in rankings:
+        for rank, (_, memory) in enumerate(results, 1):
+            fused[memory.id] = fused.get(memory.id, 0.0) + weight / (k + rank)
+            memories[memory.id] = memory
+    top = heapq.nlargest(count, fused.items(), key=lambda item: item[1])
+    return [(score, memories[memory_id]) for memory_id, score in top]
+
+
+@functools.lru_cache(maxsize=65536)
+def _hash64(token: str) -> int:
+    """Stable 64-bit hash of a token."""
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def _simhash(text: str) -> int:
+    """64-bit SimHash fingerprint of a memory's words, ignoring its category tag."""
+    counts: Dict[str, int] = {}
+    for token in _tokenize(_CATEGORY_PATTERN.sub("", text, count=1)):
+        counts[token] = counts.get(token, 0) + 1
+    weights = [0] * 64
+    for token, count in counts.items():
+        hashed = _hash64(token)
+        for bit in range(64):
+            weights[bit] += count if hashed >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def _merge_memory_content(existing: str, new: str) -> str:
+    """Append the lines of `new` that `existing` does not already contain."""
+    known = {line.strip() for line in existing.splitlines()}
+    extra = [line for line in new.splitlines() if line.strip() and line.strip() not in known]
+    return "\n".join([existing.rstrip("\n")] + extra) if extra else existing
+
+
+class _SimHashIndex:
+    """
+    Locality-sensitive index of memory SimHash fingerprints for near-duplicate lookup.
+
+    Fingerprints are split into `max_distance + 1` bands and bucketed by band
+    value. Two fingerprints within `max_distance` differing bits must agree
+    exactly on at least one band, so a lookup only compares against memories
+    sharing a bucket instead of the whole bank.
+    """
+
+    def __init__(self, max_distance: int = 6):
+        self.max_distance = self.clamp_distance(max_distance)
+        bands = self.max_distance + 1
+        width = 64 // bands
+        self.bands = [(i * width, 64 if i == bands - 1 else (i + 1) * width) for i in range(bands)]
+        self.fingerprints: Dict[str, int] = {}
+        self.buckets: Dict[Tuple[int, int], Set[str]] = {}
+
+    @staticmethod
+    def clamp_distance(max_distance: int) -> int:
+        """Supported distance for a requested one (0-15, so every band keeps at least 4 bits)."""
+        return min(max(0, max_distance), 15)
+
+    def _keys(self, fingerprint: int) -> List[Tuple[int, int]]:
+        return [(band, (fingerprint >> low) & ((1 << (high - low)) - 1)) for band, (low, high) in enumerate(self.bands)]
+
+    def add(self, memory: Any) -> None:
+        """Index a memory, replacing any previously indexed version."""
+        self.remove(memory.id)
+        fingerprint = _simhash(memory.content)
+        self.fingerprints[memory.id] = fingerprint
+        for key in self._keys(fingerprint):
+            self.buckets.setdefault(key, set()).add(memory.id)
+
+    def remove(self, memory_id: str) -> None:
+        """Drop a memory's fingerprint and bucket entries."""
+        fingerprint = self.fingerprints.pop(memory_id, None)
+        if fingerprint is None:
+            return
+        for key in self._keys(fingerprint):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(memory_id)
+                if not bucket:
+                    del self.buckets[key]
+
+    def nearest(self, text: str) -> List[Tuple[int, str]]:
+        """(distance, memory_id) pairs within `max_distance` of the text, closest first."""
+        fingerprint = _simhash(text)
+        candidates: Set[str] = set()
+        for key in self._keys(fingerprint):
+            candidates.update(self.buckets.get(key, ()))
+        matches = []
+        for memory_id in candidates:
+            distance = bin(fingerprint ^ self.fingerprints[memory_id]).count("1")
+            if distance <= self.max_distance:
+                matches.append((distance, memory_id))
+        return sorted(matches)
+
+
+# Distinguishes successive snapshots of the same user's bank
+_SNAPSHOT_GENERATIONS = itertools.count(1)
+
+
+class _MemorySnapshot:
+    """
+    In-process copy of one user's memory bank and the indexes derived from it.
+
+    The tool's own write paths patch the snapshot (and any built index) in
+    place; `refresh` reconciles it with a fresh database read after the TTL
+    expires so external writes are picked up. `version` increases on every
+    change. `timeline` keeps (created_at, id) keys sorted for ordered paging
+    and date ranges; `categories` maps each [CATEGORY] tag to its memory ids.
+    """
+
+    def __init__(self, memories: List[Any], fetched_at: float):
+        self.memories: Dict[str, Any] = {memory.id: memory for memory in memories}
+        self.timeline: List[Tuple[Any, str]] = sorted((memory.created_at, memory.id) for memory in memories)
+        self.categories: Dict[Optional[str], Set[str]] = {}
+        for memory in memories:
+            self.categories.setdefault(_memory_category(memory.content), set()).add(memory.id)
+        self.fetched_at = fetched_at
+        self.version = 0
+        self.generation = next(_SNAPSHOT_GENERATIONS)
+        self.lexical: Optional[_MemoryIndex] = None
+        self.vector: Optional[_VectorIndex] = None
+        self.duplicates: Optional[_SimHashIndex] = None
+
+    def _timeline_discard(self, memory: Any) -> None:
+        """Remove a memory's key from the created_at-ordered timeline."""
+        key = (memory.created_at, memory.id)
+        position = bisect.bisect_left(self.timeline, key)
+        if position < len(self.timeline) and self.timeline[position] == key:
+            del self.timeline[position]
+
+    def _category_discard(self, memory: Any) -> None:
+        """Remove a memory's id from its category's id set."""
+        category = _memory_category(memory.content)
+        ids = self.categories.get(category)
+        if ids is not None:
+            ids.discard(memory.id)
+            if not ids:
+                del self.categories[category]
+
+    def select(
+        self,
+        categories: Optional[Set[str]] = None,
+        after: Optional[float] = None,
+        before: Optional[float] = None,
+    ) -> Optional[Set[str]]:
+        """
+        Ids in any of the categories and created in [after, before), via the indexes.
+
+        Returns None when no filter is given (every memory matches).
+        """
+        selected = None
+        if categories:
+            selected = set().union(*(self.categories.get(category, ()) for category in categories))
+        if after is None and before is None:
+            return selected
+        low = bisect.bisect_left(self.timeline, (after,)) if after is not None else 0
+        high = bisect.bisect_left(self.timeline, (before,)) if before is not None else len(self.timeline)
+        if selected is not None and len(selected) < high - low:
+            return {
+                memory_id for memory_id in selected
+                if (after is None or self.memories[memory_id].created_at >= after)
+                and (before is None or self.memories[memory_id].created_at < before)
+            }
+        in_range = {memory_id for _, memory_id in self.timeline[low:high]}
+        return in_range if selected is None else in_range & selected
+
+    def page(self, after: Optional[Tuple[Any, str]], limit: int) -> Tuple[int, List[Any]]:
+        """Return (offset, memories) for up to `limit` memories created after the `after` key."""
+        start = bisect.bisect_right(self.timeline, after) if after else 0
+        return start, [self.memories[memory_id] for _, memory_id in self.timeline[start:start + limit]]
+
+    def upsert(self, memory: Any) -> None:
+        """Insert or replace a memory and patch the built indexes."""
+        previous = self.memories.get(memory.id)
+        if previous is None or previous.created_at != memory.created_at:
+            if previous is not None:
+                self._timeline_discard(previous)
+            bisect.insort(self.timeline, (memory.created_at, memory.id))
+        if previous is not None:
+            self._category_discard(previous)
+        self.categories.setdefault(_memory_category(memory.content), set()).add(memory.id)
+        self.memories[memory.id] = memory
+        self.version += 1
+        if self.lexical is not None:
+            self.lexical.add(memory)
+        if self.vector is not None:
+            self.vector.add(memory)
+        if self.duplicates is not None:
+            self.duplicates.add(memory)
+
+    def remove(self, memory_id: str) -> None:
+        """Remove a memory and patch the built indexes."""
+        memory = self.memories.pop(memory_id, None)
+        if memory is None:
+            return
+        self._timeline_discard(memory)
+        self._category_discard(memory)
+        self.version += 1
+        if self.lexical is not None:
+            self.lexical.remove(memory_id)
+        if self.vector is not None:
+            self.vector.remove(memory_id)
+        if self.duplicates is not None:
+            self.duplicates.remove(memory_id)
+
+    def refresh(self, memories: List[Any], fetched_at: float) -> None:
+        """Reconcile with a fresh read, re-indexing only memories that changed."""
+        fresh = {memory.id: memory for memory in memories}
+        for memory_id in [memory_id for memory_id in self.memories if memory_id not in fresh]:
+            self.remove(memory_id)
+        for memory_id, memory in fresh.items():
+            cached = self.memories.get(memory_id)
+            if (
+                cached is None
+                or cached.content != memory.content
+                or getattr(cached, "updated_at", None) != getattr(memory, "updated_at", None)
+            ):
+                self.upsert(memory)
+        self.fetched_at = fetched_at
+
+
+class _RecencyDecay:
+    """
+    Precomputed recency weights per day-sized time bucket.
+
+    weight = 0.5 ** (age_in_days / half_life_days), tabulated once for ages
+    up to 16 half-lives (older memories share the last, near-zero weight), so
+    scoring a memory costs one integer division and a list lookup instead of
+    any datetime handling.
+    """
+
+    BUCKET_SECONDS = 86400
+
+    def __init__(self, half_life_days: float):
+        self.half_life_days = half_life_days
+        horizon = max(1, math.ceil(half_life_days * 16))
+        self.weights = [0.5 ** (age / half_life_days) for age in range(horizon + 1)]
+
+    @classmethod
+    def current_bucket(cls) -> int:
+        return int(time.time()) // cls.BUCKET_SECONDS
+
+    def weight(self, created_at: Any, current_bucket: int) -> float:
+        """Decay weight of a memory created at `created_at` (epoch seconds)."""
+        age = current_bucket - int(created_at) // self.BUCKET_SECONDS
+        return self.weights[min(max(age, 0), len(self.weights) - 1)]
+
+
+class _SearchResultCache:
+    """
+    LRU cache of ranked search_memories results.
+
+    Keys start with the user id and include the mode, normalized query,
+    count, filters, and the bank's snapshot generation and version, so any
+    write through the tool (which bumps the version) or a reloaded bank (new
+    generation) makes older entries unreachable; they age out of the LRU or
+    are purged along with the user's snapshot. Entries never hold a
+    reference to the snapshot itself.
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._user_keys: Dict[str, Set[Tuple]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Optional[Any]:
+        """Return the cached value for `key`, or None."""
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Tuple, value: Any, max_entries: int) -> None:
+        """Store a value, evicting least recently used entries beyond `max_entries`."""
+        if max_entries <= 0:
+            self._entries.clear()
+            self._user_keys.clear()
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._user_keys.setdefault(key[0], set()).add(key)
+        while len(self._entries) > max_entries:
+            self._forget_key(self._entries.popitem(last=False)[0])
+
+    def _forget_key(self, key: Tuple) -> None:
+        """Drop an evicted key from its user's key set."""
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def purge(self, user_id: str) -> None:
+        """Drop all of a user's entries, e.g. when their snapshot is evicted."""
+        for key in self._user_keys.pop(user_id, ()):
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Return current size and hit/miss counters."""
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _now_ms() -> int:
+    """Current time as integer milliseconds since the epoch."""
+    return time.time_ns() // 1_000_000
+
+
+def _format_ms(timestamp: Any) -> str:
+    """Render an integer millisecond timestamp (or a legacy ISO string) for display."""
+    if isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp / 1000).isoformat(timespec="seconds")
+
+
+def _dumps(value: Any, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """
+    Serialize to JSON text, using orjson when installed.
+
+    Non-ASCII text is kept as-is in both backends. Values orjson refuses
+    (e.g. integers beyond 64 bits) fall back to the standard library.
+    """
+    if ORJSON_AVAILABLE:
+        try:
+            return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, default=default)
+
+
+def _loads(text: Any) -> Any:
+    """Parse JSON text, using orjson when installed."""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def _to_ms(timestamp: Any) -> int:
+    """Normalize a stored timestamp (integer ms or legacy ISO string) to integer ms."""
+    if isinstance(timestamp, str):
+        return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+    return int(timestamp or 0)
+
+
+class _Entity:
+    """
+    Compact record for a declared reasoning entity.
+
+    Uses __slots__ instead of a per-entity dict and stores timestamps as
+    integer milliseconds; they are only formatted when rendered. The JSON form
+    of the value and the rendered listing line are cached and dropped whenever
+    the value is reassigned. `changed_seq` is the state history sequence
+    number of the record that last declared or changed the entity.
+    """
+
+    __slots__ = (
+        "type", "_value", "description", "declared_at", "last_modified", "modification_count", "changed_seq",
+        "_line", "_json",
+    )
+    _FIELDS = ("type", "value", "description", "declared_at", "last_modified", "modification_count", "changed_seq")
+
+    def __init__(
+        self,
+        type: str,
+        value: Any,
+        description: str = "",
+        declared_at: int = 0,
+        last_modified: Optional[int] = None,
+        modification_count: int = 0,
+        changed_seq: int = 0,
+    ):
+        self.type = type
+        self._value = value
+        self._line: Optional[str] = None
+        self._json: Optional[str] = None
+        self.description = description
+        self.declared_at = declared_at
+        self.last_modified = declared_at if last_modified is None else last_modified
+        self.modification_count = modification_count
+        self.changed_seq = changed_seq
+
+    @property
+    def value(self) -> Any:
+        return self._value
+
+    @value.setter
+    def value(self, value: Any) -> None:
+        self._value = value
+        self._line = None
+        self._json = None
+
+    def value_json(self) -> str:
+        """JSON form of the value, serialized once per assignment."""
+        if self._json is None:
+            self._json = _dumps(self._value)
+        return self._json
+
+    def to_json(self) -> str:
+        """JSON form of `to_dict`, reusing the cached value serialization."""
+        head = _dumps({field: getattr(self, field) for field in self._FIELDS if field != "value"})
+        return f'{head[:-1]},"value":{self.value_json()}}}'
+
+    def render_line(self, name: str) -> str:
+        """Listing line (value truncated, plus description) for validate_context, cached."""
+        if self._line is None:
+            value_str = self.value_json()
+            if len(value_str) > 50:
+                value_str = value_str[:47] + "..."
+            line = f"  • {name} ({self.type}): {value_str}"
+            if self.description:
+                line += f"\n    _{self.description}_"
+            self._line = line
+        return self._line
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain-data view of the entity (for size estimates and serialization)."""
+        return {field: getattr(self, field) for field in self._FIELDS}
+
+    def approx_bytes(self, name: str) -> int:
+        """Approximate serialized size of the entity stored under `name`."""
+        return len(name) + len(self.to_json()) + 4
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "_Entity":
+        """Rebuild an entity from `to_dict` output."""
+        return cls(
+            data.get("type", "object"),
+            data.get("value"),
+            data.get("description", ""),
+            _to_ms(data.get("declared_at")),
+            _to_ms(data.get("last_modified", data.get("declared_at"))),
+            data.get("modification_count", 0),
+            data.get("changed_seq", 0),
+        )
+
+
+class _StateHistory:
+    """
+    Fixed-capacity ring buffer of reasoning state changes with checkpoints.
+
+    Only the newest `capacity` records are kept. Update records carry a patch
+    (see `_json_diff`) against the entity's previous value rather than full
+    old/new copies. Every `checkpoint_interval` records (and after every
+    declaration) a compact checkpoint of all entity values is taken, so past
+    states can still be materialized by replaying the retained patches on top
+    of the nearest checkpoint. Checkpoints older than the oldest retained
+    record are dropped, so memory stays flat however long the session runs.
+    """
+
+    def __init__(self, capacity: int = 200, checkpoint_interval: int = 25):
+        self.capacity = max(1, capacity)
+        self.checkpoint_interval = max(1, checkpoint_interval)
+        self.records: deque = deque(maxlen=self.capacity)
+        self.checkpoints: deque = deque()
+        self.seq = 0
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def append(self, record: Dict, entities: Dict[str, _Entity], checkpoint: bool = False, measure: bool = False) -> int:
+        """
+        Append a record (numbered by `seq`) and checkpoint when due or requested.
+
+        With `measure`, returns the approximate change in serialized size
+        (new record and checkpoint, minus whatever fell out); otherwise 0.
+        """
+        growth = 0
+        record["seq"] = self.seq
+        if measure:
+            growth += len(_dumps(record))
+            if len(self.records) == self.records.maxlen:
+                growth -= len(_dumps(self.records[0]))
+        self.records.append(record)
+        self.seq += 1
+        if checkpoint or self.seq % self.checkpoint_interval == 0:
+            values = {name: copy.deepcopy(entity.value) for name, entity in entities.items()}
+            if measure:
+                growth += sum(len(name) + len(entity.value_json()) + 4 for name, entity in entities.items())
+            self.checkpoints.append((self.seq, values))
+        # Replay needs every record after a checkpoint, so older ones are useless
+        oldest = self.seq - len(self.records)
+        while self.checkpoints and self.checkpoints[0][0] < oldest:
+            dropped = self.checkpoints.popleft()
+            if measure:
+                growth -= len(_dumps(dropped[1]))
+        return growth
+
+    def state_at(self, seq: int) -> Optional[Dict[str, Any]]:
+        """Entity values as they were after the first `seq` records, or None if no longer retained."""
+        oldest = self.seq - len(self.records)
+        for checkpoint_seq, values in reversed(self.checkpoints):
+            if checkpoint_seq > seq:
+                continue
+            if checkpoint_seq < oldest and checkpoint_seq != seq:
+                return None
+            state = copy.deepcopy(values)
+            for record in self.records:
+                if checkpoint_seq <= record["seq"] < seq:
+                    for change in self._changes(record):
+                        state[change["entity"]] = _apply_patch(state.get(change["entity"]), change["patch"])
+            return state
+        return None
+
+    @staticmethod
+    def _changes(record: Dict) -> List[Dict]:
+        """Per-entity changes ({entity, version, patch}) carried by a record."""
+        if record["action"] == "update":
+            return [record]
+        if record["action"] == "update_many":
+            return record["changes"]
+        return []
+
+    def entity_versions(self, name: str) -> List[Tuple[int, Dict, Optional[Dict]]]:
+        """Retained (version, record, change) entries for an entity since its latest declaration, oldest first."""
+        versions = []
+        for record in reversed(self.records):
+            if record["action"] == "declare" and name in record.get("entities", ()):
+                versions.append((0, record, None))
+                break
+            for change in self._changes(record):
+                if change["entity"] == name:
+                    versions.append((change["version"], record, change))
+        return versions[::-1]
+
+    def materialize(self, name: str, version: int) -> Tuple[bool, Any]:
+        """Return (found, value) for an entity as it was at a given modification count."""
+        for entry_version, record, _ in self.entity_versions(name):
+            if entry_version == version:
+                state = self.state_at(record["seq"] + 1)
+                if state is not None and name in state:
+                    return True, state[name]
+        return False, None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain-data view of the history (for size estimates and serialization)."""
+        return {
+            "capacity": self.capacity,
+            "checkpoint_interval": self.checkpoint_interval,
+            "seq": self.seq,
+            "records": list(self.records),
+            "checkpoints": [list(checkpoint) for checkpoint in self.checkpoints],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "_StateHistory":
+        """Rebuild a history from `to_dict` output."""
+        history = cls(data.get("capacity", 200), data.get("checkpoint_interval", 25))
+        history.seq = data.get("seq", 0)
+        history.records.extend(data.get("records", []))
+        history.checkpoints.extend(tuple(checkpoint) for checkpoint in data.get("checkpoints", []))
+        return history
+
+
+_MAX_PATCH_OPS = 16
+
+
+def _json_diff(old: Any, new: Any, path: Tuple = ()) -> List[Dict]:
+    """
+    Structural diff of two JSON values as a list of patch operations.
+
+    Each operation is {"op": "add"|"remove"|"replace", "path": [keys...]}
+    plus "value" for add/replace. Objects are diffed per key and arrays per
+    index (with additions/removals at the tail); anything else is replaced.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [{"op": "remove", "path": [*path, key]} for key in old if key not in new]
+        for key, value in new.items():
+            if key in old:
+                ops.extend(_json_diff(old[key], value, (*path, key)))
+            else:
+                ops.append({"op": "add", "path": [*path, key], "value": value})
+        return ops
+    if isinstance(old, list) and isinstance(new, list):
+        common = min(len(old), len(new))
+        ops = []
+        for idx in range(common):
+            ops.extend(_json_diff(old[idx], new[idx], (*path, idx)))
+        ops.extend({"op": "add", "path": [*path, idx], "value": new[idx]} for idx in range(common, len(new)))
+        ops.extend({"op": "remove", "path": [*path, idx]} for idx in range(len(old) - 1, common - 1, -1))
+        return ops
+    if type(old) is not type(new) or old != new:
+        return [{"op": "replace", "path": list(path), "value": new}]
+    return []
+
+
+def _make_patch(old: Any, new: Any) -> List[Dict]:
+    """Diff two values, falling back to a single root replace for large rewrites."""
+    ops = _json_diff(old, new)
+    if len(ops) > _MAX_PATCH_OPS:
+        return [{"op": "replace", "path": [], "value": new}]
+    return ops
+
+
+def _apply_patch(value: Any, ops: List[Dict]) -> Any:
+    """Apply patch operations to a value (mutated in place where possible) and return it."""
+    for op in ops:
+        path = op["path"]
+        if not path:
+            value = copy.deepcopy(op.get("value"))
+            continue
+        parent = value
+        for key in path[:-1]:
+            parent = parent[key]
+        key = path[-1]
+        if op["op"] == "remove":
+            del parent[key]
+        elif op["op"] == "add" and isinstance(parent, list):
+            parent.insert(key, copy.deepcopy(op["value"]))
+        else:
+            parent[key] = copy.deepcopy(op["value"])
+    return value
+
+
+class _RelationshipGraph:
+    """
+    Forward and reverse adjacency index over declared entity relationships.
+
+    Every edge (source -[type]-> target) is indexed in both directions, so
+    "what does X point to" and "what points to X" are O(degree) lookups
+    instead of scans over the full edge list. Declaring an edge that already
+    exists replaces its type.
+    """
+
+    def __init__(self):
+        self.forward: Dict[str, Dict[str, str]] = {}
+        self.reverse: Dict[str, Dict[str, str]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(targets) for targets in self.forward.values())
+
+    def add(self, source: str, target: str, relation: str) -> None:
+        self.forward.setdefault(source, {})[target] = relation
+        self.reverse.setdefault(target, {})[source] = relation
+
+    def neighbors(self, name: str, incoming: bool = False, relation: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Direct (entity, relation) neighbours of `name`, optionally of one relation type."""
+        edges = (self.reverse if incoming else self.forward).get(name, {})
+        return [(other, rel) for other, rel in edges.items() if relation is None or rel == relation]
+
+    def traverse(
+        self, name: str, incoming: bool = False, relation: Optional[str] = None, depth: int = 1
+    ) -> List[Tuple[str, str, int, str]]:
+        """
+        Breadth-first walk from `name` up to `depth` hops.
+
+        Returns (entity, relation, distance, via) tuples in visiting order; only
+        the reachable subgraph is touched.
+        """
+        seen = {name}
+        frontier = [name]
+        found = []
+        for distance in range(1, max(1, depth) + 1):
+            next_frontier = []
+            for current in frontier:
+                for other, rel in self.neighbors(current, incoming, relation):
+                    if other not in seen:
+                        seen.add(other)
+                        found.append((other, rel, distance, current))
+                        next_frontier.append(other)
+            if not next_frontier:
+                break
+            frontier = next_frontier
+        return found
+
+    def find_cycles(self, relation: Optional[str] = None, limit: int = 10) -> List[List[str]]:
+        """Cycles along forward edges (iterative DFS, one cycle per back edge), up to `limit`."""
+        cycles = []
+        done: Set[str] = set()
+        for root in self.forward:
+            if root in done:
+                continue
+            path = [root]
+            on_path = {root: 0}
+            stack = [iter(self.neighbors(root, relation=relation))]
+            while stack:
+                step = next(stack[-1], None)
+                if step is None:
+                    stack.pop()
+                    node = path.pop()
+                    del on_path[node]
+                    done.add(node)
+                    continue
+                other = step[0]
+                if other in on_path:
+                    cycles.append(path[on_path[other]:] + [other])
+                    if len(cycles) >= limit:
+                        return cycles
+                elif other not in done:
+                    on_path[other] = len(path)
+                    path.append(other)
+                    stack.append(iter(self.neighbors(other, relation=relation)))
+        return cycles
+
+    def to_dict(self) -> List[Dict[str, str]]:
+        """Edge list form (for size estimates and serialization)."""
+        return [
+            {"source": source, "target": target, "type": relation}
+            for source, targets in self.forward.items()
+            for target, relation in targets.items()
+        ]
+
+    @classmethod
+    def from_dict(cls, edges: List[Dict[str, str]]) -> "_RelationshipGraph":
+        """Rebuild the index from `to_dict` output."""
+        graph = cls()
+        for edge in edges:
+            if isinstance(edge, dict) and edge.get("source") and edge.get("target"):
+                graph.add(edge["source"], edge["target"], edge.get("type", "related_to"))
+        return graph
+
+
+def _json_default(value: Any) -> Any:
+    """`_dumps` fallback for the tool's own container types."""
+    if hasattr(value, "to_dict"):
+        return value.to_dict()
+    if isinstance(value, (deque, set)):
+        return list(value)
+    return str(value)
+
+
+class _ContextStore:
+    """
+    Bounded per-user store for reasoning contexts.
+
+    Contexts are kept in least-recently-used order and evicted when the store
+    exceeds its user limit, when they sit idle longer than the idle TTL, or
+    while the approximate total size exceeds the byte budget. A context is
+    measured (as serialized JSON length) once when stored; after that callers
+    report size changes through `resize` as they mutate it. Sizes are only
+    tracked while a byte budget is set, and everything is re-measured when
+    one is set again. `evictions` counts evictions per reason;
+    `on_evict(user_id, context)` is called for each.
+    """
+
+    def __init__(self):
+        self.on_evict: Optional[Callable[[str, Dict], None]] = None
+        self._contexts: "OrderedDict[str, Dict]" = OrderedDict()
+        self._last_access: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._stale: Set[str] = set()
+        self._total_bytes = 0
+        self._tracking = False
+        self.evictions: Dict[str, int] = {"max_users": 0, "idle": 0, "bytes": 0}
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._contexts
+
+    def __len__(self) -> int:
+        return len(self._contexts)
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        """Return a user's context and mark it as most recently used."""
+        context = self._contexts.get(user_id)
+        if context is not None:
+            self._contexts.move_to_end(user_id)
+            self._last_access[user_id] = time.monotonic()
+        return context
+
+    def peek(self, user_id: str) -> Optional[Dict]:
+        """Return a user's context without touching its recency."""
+        return self._contexts.get(user_id)
+
+    def put(self, user_id: str, context: Dict) -> None:
+        """Store a user's context as most recently used."""
+        self.pop(user_id)
+        self._contexts[user_id] = context
+        self._last_access[user_id] = time.monotonic()
+        self._sizes[user_id] = 0
+        self._stale.add(user_id)
+
+    def pop(self, user_id: str) -> Optional[Dict]:
+        """Remove and return a user's context."""
+        context = self._contexts.pop(user_id, None)
+        self._last_access.pop(user_id, None)
+        self._total_bytes -= self._sizes.pop(user_id, 0)
+        self._stale.discard(user_id)
+        return context
+
+    def resize(self, user_id: str, delta: int) -> None:
+        """Adjust a context's tracked size after the caller changed it."""
+        if self._tracking and user_id in self._sizes and user_id not in self._stale:
+            self._sizes[user_id] += delta
+            self._total_bytes += delta
+
+    def enforce(self, max_users: int, idle_ttl: float, max_bytes: int, keep: Optional[str] = None) -> None:
+        """Evict contexts over the user limit, idle TTL or byte budget, never evicting `keep`."""
+        if max_bytes > 0:
+            if not self._tracking:
+                # Changes were not tracked without a budget; measure everything once
+                self._tracking = True
+                self._stale.update(self._contexts)
+            self._measure()
+        else:
+            self._tracking = False
+
+        now = time.monotonic()
+        for user_id in list(self._contexts):
+            if len(self._contexts) > max(1, max_users):
+                reason = "max_users"
+            elif idle_ttl > 0 and now - self._last_access[user_id] > idle_ttl:
+                reason = "idle"
+            elif max_bytes > 0 and self._total_bytes > max_bytes:
+                reason = "bytes"
+            else:
+                # Remaining contexts are more recently used than this one
+                break
+            if user_id == keep:
+                continue
+            context = self.pop(user_id)
+            self.evictions[reason] += 1
+            if self.on_evict is not None:
+                self.on_evict(user_id, context)
+
+    def _measure(self) -> None:
+        """Measure contexts stored since the last measurement."""
+        for user_id in self._stale:
+            if user_id in self._contexts:
+                size = len(_dumps(self._contexts[user_id], default=_json_default))
+                self._total_bytes += size - self._sizes.get(user_id, 0)
+                self._sizes[user_id] = size
+        self._stale = set()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return current size (None while no byte budget is set) and eviction counters."""
+        if self._tracking:
+            self._measure()
+        return {
+            "users": len(self._contexts),
+            "approx_bytes": self._total_bytes if self._tracking else None,
+            "evictions": dict(self.evictions),
+        }
+
+
+class _SQLiteContextBackend:
+    """
+    Persists reasoning contexts in a local SQLite database (WAL mode).
+
+    Context metadata (task, history, timestamps) is stored as one JSON row per
+    user and each declared entity as its own JSON row, so only changed
+    entities need rewriting. Methods are blocking; call them through the
+    database thread pool. Any object with the same `load`, `save_many` and
+    `delete` methods can serve as a backend.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reasoning_contexts "
+                "(user_id TEXT PRIMARY KEY, meta TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reasoning_entities "
+                "(user_id TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (user_id, name))"
+            )
+            self._conn.commit()
+
+    def load(self, user_id: str) -> Optional[Tuple[str, Dict[str, str]]]:
+        """Return (meta_json, {entity_name: entity_json}) for a user, or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT meta FROM reasoning_contexts WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            entities = self._conn.execute(
+                "SELECT name, data FROM reasoning_entities WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return row[0], dict(entities)
+
+    def save_many(self, writes: List[Tuple[str, str, Dict[str, str]]]) -> None:
+        """Write (user_id, meta_json, {entity_name: entity_json}) batches in one transaction."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO reasoning_contexts (user_id, meta, updated_at) VALUES (?, ?, ?)",
+                [(user_id, meta, now) for user_id, meta, _ in writes],
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO reasoning_entities (user_id, name, data) VALUES (?, ?, ?)",
+                [(user_id, name, data) for user_id, _, entities in writes for name, data in entities.items()],
+            )
+
+    def delete(self, user_id: str) -> None:
+        """Remove a user's stored context."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM reasoning_entities WHERE user_id = ?", (user_id,))
+            self._conn.execute("DELETE FROM reasoning_contexts WHERE user_id = ?", (user_id,))
+
 
 class Tools:
     """
@@ -69,6 +1465,138 @@ class Tools:
             default=10,
             description="Maximum number of memories to return per search."
         )
+        BM25_K1: float = Field(
+            default=1.2,
+            description="BM25 term frequency saturation for memory search ranking."
+        )
+        BM25_B: float = Field(
+            default=0.75,
+            description="BM25 document length normalization (0 = none, 1 = full)."
+        )
+        SEARCH_MODE: str = Field(
+            default="lexical",
+            description="Default memory search mode: 'lexical' (BM25 keywords), 'vector' (semantic similarity) or 'hybrid' (both, fused). Vector and hybrid require numpy."
+        )
+        EMBEDDING_DIM: int = Field(
+            default=256,
+            description="Dimensions of the built-in offline hashing embedder used by vector search."
+        )
+        VECTOR_MIN_SIMILARITY: float = Field(
+            default=0.25,
+            description="Minimum cosine similarity for a vector match; below it, vector and hybrid searches fall back to recent memories like lexical mode. With the built-in embedder, short queries score about 0.3 or more against memories on the same topic, while 95% of unrelated pairs score under 0.2 (shared word pieces still give some unrelated pairs up to about 0.3)."
+        )
+        HYBRID_RRF_K: int = Field(
+            default=60,
+            description="Reciprocal rank fusion constant for hybrid search (higher flattens rank differences)."
+        )
+        HYBRID_LEXICAL_WEIGHT: float = Field(
+            default=1.0,
+            description="Weight of the lexical (BM25) ranking in hybrid search."
+        )
+        HYBRID_VECTOR_WEIGHT: float = Field(
+            default=1.0,
+            description="Weight of the vector similarity ranking in hybrid search."
+        )
+        HYBRID_CANDIDATES: int = Field(
+            default=50,
+            description="Number of candidates each scorer contributes to hybrid fusion."
+        )
+        RECENCY_WEIGHT: float = Field(
+            default=0.0,
+            description="How strongly recency affects search ranking, from 0 (relevance only) to 1 (scores fully scaled by recency decay)."
+        )
+        RECENCY_HALF_LIFE_DAYS: float = Field(
+            default=30.0,
+            description="Age in days at which a memory's recency factor drops to one half."
+        )
+        RECENCY_CANDIDATES: int = Field(
+            default=50,
+            description="Number of top matches re-ranked by recency when RECENCY_WEIGHT is above 0, in every search mode."
+        )
+        MEMORY_CACHE_TTL_SECONDS: int = Field(
+            default=60,
+            description="Seconds a cached memory bank is trusted before re-reading the database to pick up external changes."
+        )
+        MEMORY_CACHE_MAX_USERS: int = Field(
+            default=256,
+            description="Maximum number of users whose memory banks are cached (least recently used are evicted)."
+        )
+        SEARCH_CACHE_SIZE: int = Field(
+            default=256,
+            description="Maximum number of cached search_memories results across all users (0 disables the cache)."
+        )
+        AUTO_RECALL_COUNT: int = Field(
+            default=3,
+            description="Number of related memories attached to declare_reasoning_context when a user enables AUTO_RECALL_ON_START."
+        )
+        AUTO_RECALL_MIN_SHARED_TERMS: int = Field(
+            default=2,
+            description="Words (other than stopwords) a memory must share with the task description and entity names to be recalled; weaker matches are not attached."
+        )
+        DB_MAX_WORKERS: int = Field(
+            default=4,
+            description="Maximum number of concurrent memory database calls (run off the event loop)."
+        )
+        MAX_BULK_ITEMS: int = Field(
+            default=200,
+            description="Maximum number of memories accepted by a single bulk operation."
+        )
+        BULK_BATCH_SIZE: int = Field(
+            default=50,
+            description="Number of memories written per database transaction in bulk operations."
+        )
+        RECALL_PAGE_SIZE: int = Field(
+            default=50,
+            description="Default (and maximum) number of memories returned per recall_all_memories page."
+        )
+        DUPLICATE_ACTION: str = Field(
+            default="off",
+            description="What add_memory_enhanced and commit_context_to_memory do with a near-duplicate of an existing memory: 'off' (store anyway), 'reject', 'merge' (append new lines) or 'update' (replace in place; overwrites the earlier memory)."
+        )
+        DUPLICATE_MAX_DISTANCE: int = Field(
+            default=6,
+            description="Maximum SimHash bit distance (0-15, of 64) at which two memories count as near-duplicates. At 6, a one-word edit is caught in most memories of 20+ words but rarely in short facts of 5-10 words (a single word moves those 8-12 bits); unrelated text sits at 16+ bits."
+        )
+        CONTEXT_MAX_USERS: int = Field(
+            default=1000,
+            description="Maximum number of users with an in-memory reasoning context (least recently used are evicted)."
+        )
+        CONTEXT_IDLE_TTL_SECONDS: int = Field(
+            default=14400,
+            description="Evict reasoning contexts idle for longer than this many seconds (0 = never)."
+        )
+        CONTEXT_MAX_BYTES: int = Field(
+            default=50_000_000,
+            description="Approximate total size budget for all reasoning contexts, in bytes (0 = unlimited)."
+        )
+        STATE_HISTORY_CAPACITY: int = Field(
+            default=200,
+            description="Number of most recent state changes kept per reasoning context."
+        )
+        STATE_CHECKPOINT_INTERVAL: int = Field(
+            default=25,
+            description="Take a compact checkpoint of all entity values every N state changes."
+        )
+        CONTEXT_BACKEND: str = Field(
+            default="memory",
+            description="Where reasoning contexts live: 'memory' (lost on restart) or 'sqlite' (persisted locally)."
+        )
+        CONTEXT_DB_PATH: str = Field(
+            default="",
+            description="SQLite file for the 'sqlite' context backend (empty = reasoning_contexts.db in Open WebUI's DATA_DIR)."
+        )
+        CONTEXT_FLUSH_INTERVAL_SECONDS: float = Field(
+            default=2.0,
+            description="Maximum delay before changed reasoning context entities are written to the backend."
+        )
+        CONTEXT_FLUSH_BATCH_SIZE: int = Field(
+            default=50,
+            description="Write changed entities to the backend immediately once this many are pending."
+        )
+        CONSOLIDATION_INTERVAL_SECONDS: float = Field(
+            default=0,
+            description="If > 0, consolidate [CONTEXT:...] memories in the background this many seconds after a commit_context_to_memory call (0 = only on demand)."
+        )
         REQUIRE_DECLARATION: bool = Field(
             default=True,
             description="Require variable declaration before use in reasoning."
@@ -95,27 +1623,521 @@ class Tools:
     def __init__(self):
         """Initialize the Tool."""
         self.valves = self.Valves()
-        # In-memory storage for reasoning context (per-session, per-user)
-        self._reasoning_contexts: Dict[str, Dict] = {}
-
-    def _get_user_context(self, user_id: str) -> Dict:
-        """Get or create reasoning context for a user."""
-        if user_id not in self._reasoning_contexts:
-            self._reasoning_contexts[user_id] = {
-                "declared_entities": {},
-                "entity_types": {},
-                "relationships": [],
-                "state_history": [],
-                "created_at": datetime.now().isoformat(),
-                "last_validated": None,
-            }
-        return self._reasoning_contexts[user_id]
+        # In-memory storage for reasoning context (per-session, per-user, bounded)
+        self._reasoning_contexts = _ContextStore()
+        self._reasoning_contexts.on_evict = self._on_context_evicted
+        # Optional persistent context backend and its pending (dirty) writes
+        self._context_backend: Optional[Any] = None
+        self._context_backend_key: Optional[str] = None
+        self._dirty_contexts: Dict[str, Set[str]] = {}
+        self._evicted_contexts: Dict[str, Dict] = {}
+        self._context_flush_task: Optional[asyncio.Task] = None
+        # Resolved when each in-progress flush has finished (written or re-queued)
+        self._context_flushes_in_flight: Set[asyncio.Future] = set()
+        # Users with new context memories awaiting background consolidation
+        self._consolidation_users: Set[str] = set()
+        self._consolidation_task: Optional[asyncio.Task] = None
+        # Cached memory banks with their search indexes (per-user, LRU ordered)
+        self._memory_snapshots: "OrderedDict[str, _MemorySnapshot]" = OrderedDict()
+        # Ranked search results keyed by query and bank version
+        self._search_cache = _SearchResultCache()
+        # Embedder for vector search; None uses the built-in hashing embedder
+        self._embedder: Optional[Any] = None
+        # Recency decay table for ranking (rebuilt when the half-life changes)
+        self._recency_decay: Optional[_RecencyDecay] = None
+        # Bounded thread pool for blocking Memories database calls
+        self._db_executor: Optional[ThreadPoolExecutor] = None
+        self._db_executor_workers = 0
+
+    def _new_user_context(self) -> Dict:
+        """Create an empty reasoning context."""
+        return {
+            "declared_entities": {},
+            "relationships": _RelationshipGraph(),
+            "state_history": _StateHistory(
+                self.valves.STATE_HISTORY_CAPACITY,
+                self.valves.STATE_CHECKPOINT_INTERVAL,
+            ),
+            "created_at": datetime.now().isoformat(),
+            "last_validated": None,
+            "validated_seq": 0,
+        }
+
+    async def _get_user_context(self, user_id: str) -> Dict:
+        """Get or create reasoning context for a user, loading it from the backend on first access."""
+        context = self._reasoning_contexts.get(user_id)
+        if context is None:
+            context = self._evicted_contexts.pop(user_id, None)
+            backend = self._get_context_backend()
+            if context is None and backend is not None:
+                try:
+                    record = await self._run_db(backend.load, user_id)
+                except Exception as e:
+                    log.warning("Cannot load reasoning context for %s, starting fresh: %s", user_id, e)
+                    record = None
+                # Another call may have loaded the context while we were waiting
+                context = self._reasoning_contexts.get(user_id)
+                if context is None and record is not None:
+                    context = self._context_from_record(*record)
+            if context is None:
+                context = self._new_user_context()
+            if self._reasoning_contexts.peek(user_id) is None:
+                self._reasoning_contexts.put(user_id, context)
+        self._reasoning_contexts.enforce(
+            self.valves.CONTEXT_MAX_USERS,
+            self.valves.CONTEXT_IDLE_TTL_SECONDS,
+            self.valves.CONTEXT_MAX_BYTES,
+            keep=user_id,
+        )
+        self._log_cache_stats()
+        return context
+
+    def _log_cache_stats(self) -> None:
+        """Log cache sizes and eviction counters at DEBUG level."""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                "Reasoning contexts: %s; search cache: %s",
+                self._reasoning_contexts.stats(),
+                self._search_cache.stats(),
+            )
 
-    def _validate_entity_exists(self, user_id: str, entity_name: str) -> bool:
+    async def _validate_entity_exists(self, user_id: str, entity_name: str) -> bool:
         """Check if an entity has been declared in the current context."""
-        context = self._get_user_context(user_id)
+        context = await self._get_user_context(user_id)
         return entity_name in context["declared_entities"]
 
+    def _get_context_backend(self) -> Optional[Any]:
+        """Return the configured context backend (None for in-memory only, or if it cannot be opened)."""
+        if self.valves.CONTEXT_BACKEND.lower() != "sqlite":
+            return None
+        path = self.valves.CONTEXT_DB_PATH or os.path.join(os.environ.get("DATA_DIR", "."), "reasoning_contexts.db")
+        if self._context_backend_key != path:
+            self._context_backend_key = path
+            try:
+                self._context_backend = _SQLiteContextBackend(path)
+            except Exception as e:
+                # Keep working in memory; retried only when the path changes
+                log.warning("Cannot open reasoning context database %s, keeping contexts in memory: %s", path, e)
+                self._context_backend = None
+        return self._context_backend
+
+    def _context_from_record(self, meta: str, entities: Dict[str, str]) -> Dict:
+        """Rebuild a context from its stored metadata and entity rows."""
+        context = _loads(meta)
+        context.pop("entity_types", None)
+        context["declared_entities"] = {name: _Entity.from_dict(_loads(data)) for name, data in entities.items()}
+        context["state_history"] = _StateHistory.from_dict(context.get("state_history") or {})
+        context["relationships"] = _RelationshipGraph.from_dict(context.get("relationships") or [])
+        return context
+
+    def _on_context_evicted(self, user_id: str, context: Dict) -> None:
+        """Keep evicted contexts with unsaved changes until they are flushed."""
+        if user_id in self._dirty_contexts:
+            self._evicted_contexts[user_id] = context
+
+    async def _mark_context_dirty(self, user_id: str, entity_names: Optional[List[str]] = None) -> None:
+        """Queue a context (and the given entities) for a batched backend write."""
+        if self._get_context_backend() is None:
+            return
+        self._dirty_contexts.setdefault(user_id, set()).update(entity_names or ())
+        if sum(len(names) for names in self._dirty_contexts.values()) >= self.valves.CONTEXT_FLUSH_BATCH_SIZE:
+            try:
+                await self._flush_contexts()
+            except Exception as e:
+                # The changes stay queued and in memory; a later flush retries them
+                log.warning("Reasoning context flush failed: %s", e)
+        elif self._context_flush_task is None or self._context_flush_task.done():
+            self._context_flush_task = asyncio.create_task(self._flush_contexts_later())
+
+    async def _flush_contexts_later(self) -> None:
+        """Flush pending context writes after the flush interval."""
+        await asyncio.sleep(self.valves.CONTEXT_FLUSH_INTERVAL_SECONDS)
+        try:
+            await self._flush_contexts()
+        except Exception as e:
+            log.warning("Reasoning context flush failed: %s", e)
+
+    async def _flush_contexts(self) -> None:
+        """Write all dirty contexts' metadata and changed entities in one transaction."""
+        backend = self._get_context_backend()
+        if backend is None or not self._dirty_contexts:
+            return
+        dirty, self._dirty_contexts = self._dirty_contexts, {}
+        evicted, self._evicted_contexts = self._evicted_contexts, {}
+        writes = []
+        for user_id, names in dirty.items():
+            context = self._reasoning_contexts.peek(user_id) or evicted.get(user_id)
+            if context is None:
+                continue
+            declared = context["declared_entities"]
+            meta = {key: value for key, value in context.items() if key != "declared_entities"}
+            writes.append((
+                user_id,
+                _dumps(meta, default=_json_default),
+                {name: declared[name].to_json() for name in names if name in declared},
+            ))
+        finished = asyncio.get_running_loop().create_future()
+        self._context_flushes_in_flight.add(finished)
+        try:
+            await self._run_db(backend.save_many, writes)
+        except Exception:
+            # Keep the changes queued so the next flush retries them
+            for user_id, names in dirty.items():
+                self._dirty_contexts.setdefault(user_id, set()).update(names)
+            for user_id, context in evicted.items():
+                self._evicted_contexts.setdefault(user_id, context)
+            raise
+        finally:
+            self._context_flushes_in_flight.discard(finished)
+            finished.set_result(None)
+
+    def _get_db_executor(self) -> ThreadPoolExecutor:
+        """Return the database thread pool, resizing it when DB_MAX_WORKERS changed."""
+        workers = max(1, self.valves.DB_MAX_WORKERS)
+        if self._db_executor is None or self._db_executor_workers != workers:
+            if self._db_executor is not None:
+                self._db_executor.shutdown(wait=False)
+            self._db_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="memory-db")
+            self._db_executor_workers = workers
+        return self._db_executor
+
+    async def _run_db(self, func: Callable, *args: Any) -> Any:
+        """Run a blocking Memories call on the database thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_db_executor(), functools.partial(func, *args))
+
+    async def _get_memory_snapshot(self, user_id: str) -> _MemorySnapshot:
+        """Get the user's cached memory bank, reading the database when missing or stale."""
+        now = time.monotonic()
+        snapshot = self._memory_snapshots.get(user_id)
+        if snapshot is None:
+            memories = await self._run_db(Memories.get_memories_by_user_id, user_id)
+            # Another call may have cached the bank while we were waiting
+            snapshot = self._memory_snapshots.get(user_id)
+            if snapshot is None:
+                snapshot = _MemorySnapshot(memories or [], now)
+                self._memory_snapshots[user_id] = snapshot
+                while len(self._memory_snapshots) > max(1, self.valves.MEMORY_CACHE_MAX_USERS):
+                    evicted_user, _ = self._memory_snapshots.popitem(last=False)
+                    self._search_cache.purge(evicted_user)
+        elif now - snapshot.fetched_at >= self.valves.MEMORY_CACHE_TTL_SECONDS:
+            memories = await self._run_db(Memories.get_memories_by_user_id, user_id)
+            snapshot.refresh(memories or [], now)
+        if user_id in self._memory_snapshots:
+            self._memory_snapshots.move_to_end(user_id)
+        return snapshot
+
+    async def _get_memory_index(self, user_id: str) -> _MemoryIndex:
+        """Get the user's inverted memory index, building it on first use."""
+        snapshot = await self._get_memory_snapshot(user_id)
+        if snapshot.lexical is None:
+            lexical = await self._build_index(snapshot, _MemoryIndex)
+            # Keep an index another call finished first; it is patched already
+            if snapshot.lexical is None:
+                snapshot.lexical = lexical
+        return snapshot.lexical
+
+    def _get_embedder(self) -> Any:
+        """Return the active embedder, creating the default hashing embedder if needed."""
+        if self._embedder is None or (
+            isinstance(self._embedder, _HashingEmbedder) and self._embedder.dim != self.valves.EMBEDDING_DIM
+        ):
+            self._embedder = _HashingEmbedder(self.valves.EMBEDDING_DIM)
+        return self._embedder
+
+    async def _build_index(self, snapshot: _MemorySnapshot, factory: Callable[[], Any]) -> Any:
+        """
+        Build a fresh index over the snapshot's memories on the database pool.
+
+        The new object is not shared until this returns, so filling it off the
+        event loop is safe; writes that landed on the snapshot meanwhile are
+        then applied to it on the loop before it is swapped in.
+        """
+        built_from = dict(snapshot.memories)
+        version = snapshot.version
+
+        def build() -> Any:
+            index = factory()
+            for memory in built_from.values():
+                index.add(memory)
+            return index
+
+        index = await self._run_db(build)
+        if snapshot.version != version:
+            for memory_id in built_from.keys() - snapshot.memories.keys():
+                index.remove(memory_id)
+            for memory_id, memory in snapshot.memories.items():
+                if built_from.get(memory_id) is not memory:
+                    index.add(memory)
+        return index
+
+    async def _get_vector_index(self, user_id: str) -> _VectorIndex:
+        """Get the user's embedding matrix, (re)building it when missing or the embedder changed."""
+        embedder = self._get_embedder()
+        snapshot = await self._get_memory_snapshot(user_id)
+        if snapshot.vector is None or snapshot.vector.embedder is not embedder:
+            vector = await self._build_index(snapshot, functools.partial(_VectorIndex, embedder))
+            if snapshot.vector is None or snapshot.vector.embedder is not embedder:
+                snapshot.vector = vector
+        return snapshot.vector
+
+    async def _find_near_duplicate(self, user_id: str, content: str) -> Optional[Any]:
+        """Find the closest existing memory of the same category that nearly duplicates `content`."""
+        snapshot = await self._get_memory_snapshot(user_id)
+        max_distance = _SimHashIndex.clamp_distance(self.valves.DUPLICATE_MAX_DISTANCE)
+        if snapshot.duplicates is None or snapshot.duplicates.max_distance != max_distance:
+            duplicates = await self._build_index(snapshot, functools.partial(_SimHashIndex, max_distance))
+            if snapshot.duplicates is None or snapshot.duplicates.max_distance != max_distance:
+                snapshot.duplicates = duplicates
+        category = _memory_category(content)
+        for _, memory_id in snapshot.duplicates.nearest(content):
+            memory = snapshot.memories[memory_id]
+            if _memory_category(memory.content) == category:
+                return memory
+        return None
+
+    async def _store_memory(self, user_id: str, content: str) -> Tuple[Optional[Any], str]:
+        """
+        Insert a memory, applying DUPLICATE_ACTION when a near-duplicate already exists.
+
+        Returns (memory, action) where action is "stored", "rejected" (memory is the
+        existing duplicate), "merged" or "updated".
+        """
+        action = self.valves.DUPLICATE_ACTION
+        if action not in ("off", "reject", "merge", "update"):
+            raise ValueError(f"Unknown duplicate action '{action}'. Use 'off', 'reject', 'merge' or 'update'.")
+        duplicate = None if action == "off" else await self._find_near_duplicate(user_id, content)
+        if duplicate is None:
+            memory = await self._run_db(Memories.insert_new_memory, user_id, content)
+            action = "stored"
+        elif action == "reject":
+            return duplicate, "rejected"
+        else:
+            if action == "merge":
+                merged = _merge_memory_content(duplicate.content, content)
+                if merged == duplicate.content:
+                    return duplicate, "merged"
+                if len(merged) <= _MAX_MEMORY_LENGTH:
+                    content = merged
+                else:
+                    action = "update"
+            memory = await self._run_db(Memories.update_memory_by_id, duplicate.id, content)
+            action = "merged" if action == "merge" else "updated"
+        if memory:
+            self._record_memory_write(user_id, memory)
+        return memory, action
+
+    async def _consolidate_user_contexts(self, user_id: str, dry_run: bool = False) -> Tuple[int, int, int]:
+        """
+        Compact a user's [CONTEXT:...] memories (see `_plan_context_consolidation`).
+
+        The newest memories of each group are rewritten in place, the rest deleted.
+        Returns (groups, memories before, memories after).
+        """
+        plans = _plan_context_consolidation(await self._select_memories(user_id, "CONTEXT"))
+        before = sum(len(group) for group, _ in plans)
+        after = sum(len(contents) for _, contents in plans)
+        if dry_run or not plans:
+            return len(plans), before, after
+        changes: Dict[str, str] = {}
+        inserts: List[str] = []
+        removals: List[str] = []
+        for group, contents in plans:
+            changes.update((memory.id, content) for memory, content in zip(group, contents))
+            inserts.extend(contents[len(group):])
+            removals.extend(memory.id for memory in group[len(contents):])
+        for memory in (await self._run_db(_update_memory_batch, user_id, changes)).values():
+            self._record_memory_write(user_id, memory)
+        if inserts:
+            for memory in await self._run_db(_insert_memory_batch, user_id, inserts):
+                self._record_memory_write(user_id, memory)
+        for memory_id in await self._run_db(_delete_memory_batch, user_id, removals):
+            self._record_memory_delete(user_id, memory_id)
+        return len(plans), before, after
+
+    def _schedule_consolidation(self, user_id: str) -> None:
+        """Queue a user for background context consolidation, if enabled."""
+        if self.valves.CONSOLIDATION_INTERVAL_SECONDS <= 0:
+            return
+        self._consolidation_users.add(user_id)
+        if self._consolidation_task is None or self._consolidation_task.done():
+            self._consolidation_task = asyncio.create_task(self._consolidate_later())
+
+    async def _consolidate_later(self) -> None:
+        """Consolidate queued users after the interval, until none are left."""
+        while self._consolidation_users:
+            await asyncio.sleep(self.valves.CONSOLIDATION_INTERVAL_SECONDS)
+            users, self._consolidation_users = self._consolidation_users, set()
+            for user_id in users:
+                try:
+                    await self._consolidate_user_contexts(user_id)
+                except Exception as e:
+                    # Best effort: the next commit queues the user again
+                    log.warning("Background context consolidation failed for %s: %s", user_id, e)
+
+    async def _filter_memories(self, user_id: str, search: _SearchQuery) -> Optional[Set[str]]:
+        """Ids matching a compiled query's filters (None = no filters), resolved through the indexes."""
+        snapshot = await self._get_memory_snapshot(user_id)
+        allowed = snapshot.select(search.categories, search.after, search.before)
+        if search.phrases:
+            index = await self._get_memory_index(user_id)
+            for phrase in search.phrases:
+                candidates = index.containing(set(_tokenize(phrase)))
+                if allowed is not None:
+                    candidates &= allowed
+                allowed = {
+                    memory_id for memory_id in candidates
+                    if phrase in snapshot.memories[memory_id].content.lower()
+                }
+        return allowed
+
+    async def _cached_search(
+        self, user_id: str, snapshot: _MemorySnapshot, search: _SearchQuery, mode: str, count: int
+    ) -> Tuple[List[Tuple[float, Any]], str]:
+        """`_rank_memories` through the per-version search result cache."""
+        cache_key = (
+            user_id, mode, search.text.lower(), count,
+            tuple(sorted(search.categories)), search.after, search.before, tuple(search.phrases),
+            snapshot.generation, snapshot.version, self.valves.BM25_K1, self.valves.BM25_B, self.valves.EMBEDDING_DIM,
+            self.valves.HYBRID_RRF_K, self.valves.HYBRID_LEXICAL_WEIGHT,
+            self.valves.HYBRID_VECTOR_WEIGHT, self.valves.HYBRID_CANDIDATES, self.valves.VECTOR_MIN_SIMILARITY,
+            self.valves.RECENCY_WEIGHT, self.valves.RECENCY_HALF_LIFE_DAYS, self.valves.RECENCY_CANDIDATES,
+            _RecencyDecay.current_bucket() if self.valves.RECENCY_WEIGHT > 0 else None,
+        )
+        cached = self._search_cache.get(cache_key)
+        if cached is None:
+            cached = await self._rank_memories(user_id, snapshot, search, mode, count)
+            self._search_cache.put(cache_key, cached, self.valves.SEARCH_CACHE_SIZE)
+        self._log_cache_stats()
+        return cached
+
+    async def _recall_for_task(self, user_id: str, task_description: str, entity_names: List[str]) -> List[Any]:
+        """Memories sharing enough words with a task and its entity names (no recent-memory fallback)."""
+        if not MEMORIES_AVAILABLE or not self.valves.ENABLE_MEMORY_OPS:
+            return []
+        snapshot = await self._get_memory_snapshot(user_id)
+        if not snapshot.memories:
+            return []
+        mode = self.valves.SEARCH_MODE.lower()
+        if mode not in ("lexical", "vector", "hybrid") or (mode != "lexical" and not NUMPY_AVAILABLE):
+            mode = "lexical"
+        text = " ".join([task_description] + [name.replace("_", " ") for name in entity_names])
+        terms = set(_tokenize(text)) - _STOPWORDS
+        if not terms:
+            return []
+        # A short task cannot share more words than it has
+        min_shared = min(self.valves.AUTO_RECALL_MIN_SHARED_TERMS, len(terms))
+        count = min(self.valves.AUTO_RECALL_COUNT, self.valves.MAX_MEMORIES_PER_SEARCH)
+        results, fallback_msg = await self._cached_search(user_id, snapshot, _SearchQuery.plain(text), mode, max(1, count))
+        if fallback_msg:
+            return []
+        return [memory for _, memory in results if len(terms.intersection(_tokenize(memory.content))) >= min_shared]
+
+    async def _rank_memories(
+        self, user_id: str, snapshot: _MemorySnapshot, search: _SearchQuery, mode: str, count: int
+    ) -> Tuple[List[Tuple[float, Any]], str]:
+        """Score the user's memories for a compiled query; returns (results, fallback message)."""
+        index = await self._get_memory_index(user_id)
+        # With recency blending, score a wider pool and re-rank it
+        recency_weight = min(max(self.valves.RECENCY_WEIGHT, 0.0), 1.0)
+        if self.valves.RECENCY_HALF_LIFE_DAYS <= 0:
+            recency_weight = 0.0
+        candidates = max(count, self.valves.RECENCY_CANDIDATES) if recency_weight > 0 else count
+        # Narrow to the filtered ids first so only those are scored
+        allowed = await self._filter_memories(user_id, search)
+        if allowed is not None and not allowed:
+            results = []
+        elif not search.text:
+            results = []
+        elif mode == "hybrid":
+            # Reciprocal rank fusion of BM25 and vector rankings
+            results = await self._hybrid_search(user_id, index, search.text, candidates, allowed)
+        elif mode == "vector":
+            # Cosine similarity against the user's embedding matrix
+            vector_index = await self._get_vector_index(user_id)
+            results = vector_index.search(search.text, candidates, allowed, self.valves.VECTOR_MIN_SIMILARITY)
+        else:
+            # BM25 relevance scoring over the query terms
+            results = index.search(search.text, candidates, k1=self.valves.BM25_K1, b=self.valves.BM25_B, allowed=allowed)
+
+        if results and recency_weight > 0:
+            results = self._apply_recency(results, recency_weight, count)
+
+        if not results and allowed is not None:
+            # Filters only (or no ranked match): most recent matching memories
+            recent = heapq.nlargest(count, allowed, key=lambda memory_id: snapshot.memories[memory_id].created_at)
+            results = [(0, snapshot.memories[memory_id]) for memory_id in recent]
+            fallback_msg = "(Showing most recent memories matching the filters)" if results else ""
+        elif not results:
+            # Fallback: the newest memories, read off the end of the sorted timeline
+            results = [(0, snapshot.memories[memory_id]) for _, memory_id in reversed(snapshot.timeline[-count:])]
+            fallback_msg = "(No exact matches, showing recent memories)"
+        else:
+            fallback_msg = ""
+        return results, fallback_msg
+
+    def _apply_recency(self, results: List[Tuple[float, Any]], weight: float, count: int) -> List[Tuple[float, Any]]:
+        """Scale relevance scores by the blended recency factor and keep the top `count`."""
+        half_life = self.valves.RECENCY_HALF_LIFE_DAYS
+        if self._recency_decay is None or self._recency_decay.half_life_days != half_life:
+            self._recency_decay = _RecencyDecay(half_life)
+        decay = self._recency_decay
+        current = _RecencyDecay.current_bucket()
+        rescored = [
+            (score * (1.0 - weight + weight * decay.weight(memory.created_at, current)), memory)
+            for score, memory in results
+        ]
+        return heapq.nlargest(count, rescored, key=lambda item: item[0])
+
+    async def _select_memories(
+        self, user_id: str, category: Optional[str] = None, created_before: Optional[str] = None
+    ) -> List[Any]:
+        """Select the user's memories matching a category tag and/or a created-before cutoff."""
+        cutoff = _parse_timestamp(created_before) if created_before else None
+        wanted = {category.strip("[] ").upper()} if category else None
+        snapshot = await self._get_memory_snapshot(user_id)
+        selected = snapshot.select(wanted, before=cutoff)
+        if selected is None:
+            return list(snapshot.memories.values())
+        return [memory for memory_id, memory in snapshot.memories.items() if memory_id in selected]
+
+    async def _hybrid_search(
+        self, user_id: str, index: _MemoryIndex, query: str, count: int, allowed: Optional[Set[str]] = None
+    ) -> List[Tuple[float, Any]]:
+        """
+        Run the lexical and vector scorers and fuse their rankings.
+
+        Both scorers run inline on the event loop: the indexes are patched in
+        place by concurrent writes, so they must not be read from other threads.
+        """
+        vector_index = await self._get_vector_index(user_id)
+        candidates = max(count, self.valves.HYBRID_CANDIDATES)
+        lexical_results = index.search(query, candidates, self.valves.BM25_K1, self.valves.BM25_B, allowed)
+        vector_results = vector_index.search(query, candidates, allowed, self.valves.VECTOR_MIN_SIMILARITY)
+        return _reciprocal_rank_fusion(
+            [
+                (self.valves.HYBRID_LEXICAL_WEIGHT, lexical_results),
+                (self.valves.HYBRID_VECTOR_WEIGHT, vector_results),
+            ],
+            k=self.valves.HYBRID_RRF_K,
+            count=count,
+        )
+
+    def _record_memory_write(self, user_id: str, memory: Any) -> None:
+        """Write an inserted or updated memory through to the user's cached bank."""
+        # Updates by id are not scoped to the user; never cache someone else's memory
+        if getattr(memory, "user_id", user_id) != user_id:
+            return
+        snapshot = self._memory_snapshots.get(user_id)
+        if snapshot is not None:
+            snapshot.upsert(memory)
+
+    def _record_memory_delete(self, user_id: str, memory_id: str) -> None:
+        """Remove a deleted memory from the user's cached bank."""
+        snapshot = self._memory_snapshots.get(user_id)
+        if snapshot is not None:
+            snapshot.remove(memory_id)
+
     # =========================================================================
     # STRUCTURED REASONING CONTEXT MANAGEMENT
     # =========================================================================
@@ -124,6 +2146,7 @@ class Tools:
         self,
         entities: List[Dict],
         task_description: str,
+        relationships: Optional[List[Dict]] = None,
         __user__: Optional[dict] = None,
         __event_emitter__: Optional[Callable[[dict], Any]] = None,
     ) -> str:
@@ -149,12 +2172,17 @@ class Tools:
             {"name": "primary_color", "type": "string", "value": "#1976D2", "description": "Primary brand color"}
         ]
 
+        Relationship structure (both ends must be declared):
+        {"source": "board", "target": "header_text", "type": "contains"}
+        {"source": "header_text", "target": "primary_color", "type": "depends_on"}
+
         :param entities: List of entity declarations with name, type, value, and description
         :param task_description: Brief description of the reasoning task being performed
+        :param relationships: Optional list of relationships with source, target, and type
         :return: Confirmation of declared entities and validation status
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         user_id = __user__.get("id", "anonymous")
         
@@ -168,18 +2196,25 @@ class Tools:
                 }
             })
 
-        context = self._get_user_context(user_id)
-        now = datetime.now().isoformat()
+        context = await self._get_user_context(user_id)
+        now_ms = _now_ms()
         
         # Record the task
         context["task_description"] = task_description
-        context["declaration_time"] = now
+        context["declaration_time"] = _format_ms(now_ms)
         
         # Process entity declarations
         declared = []
+        declared_names = []
         errors = []
+        # Track the size change only while a byte budget is enforced
+        measure = self.valves.CONTEXT_MAX_BYTES > 0
+        growth = 0
         
-        for entity in entities:
+        for idx, entity in enumerate(entities, 1):
+            if not isinstance(entity, dict):
+                errors.append(f"Malformed entity #{idx}: expected an object with name, type and value")
+                continue
             name = entity.get("name")
             if not name:
                 errors.append("Entity missing 'name' field")
@@ -191,42 +2226,81 @@ class Tools:
                 continue
             
             entity_type = entity.get("type", "object")
-            value = entity.get("value")
+            # Copy so later in-place changes by the caller cannot alter stored state
+            value = copy.deepcopy(entity.get("value"))
             description = entity.get("description", "")
             
             # Store the declaration
-            context["declared_entities"][name] = {
-                "type": entity_type,
-                "value": value,
-                "description": description,
-                "declared_at": now,
-                "last_modified": now,
-                "modification_count": 0,
-            }
-            context["entity_types"][name] = entity_type
+            stored = _Entity(entity_type, value, description, now_ms, changed_seq=context["state_history"].seq)
+            if measure:
+                previous = context["declared_entities"].get(name)
+                growth += stored.approx_bytes(name) - (previous.approx_bytes(name) if previous else 0)
+            context["declared_entities"][name] = stored
+            declared_names.append(name)
             
-            declared.append(f"  • {name}: {entity_type}" + (f" = {json.dumps(value)}" if value is not None else ""))
+            declared.append(f"  • {name}: {entity_type}" + (f" = {stored.value_json()}" if value is not None else ""))
+
+        # Index relationships between declared entities
+        graph = context["relationships"]
+        linked = []
+        for idx, relationship in enumerate(relationships or [], 1):
+            if not isinstance(relationship, dict):
+                errors.append(f"Malformed relationship #{idx}: expected an object with source, target and type")
+                continue
+            source = relationship.get("source")
+            target = relationship.get("target")
+            relation = relationship.get("type") or "related_to"
+            if not source or not target:
+                errors.append("Relationship missing 'source' or 'target' field")
+                continue
+            missing = [name for name in (source, target) if name not in context["declared_entities"]]
+            if missing:
+                errors.append(f"Relationship {source} -[{relation}]-> {target}: undeclared {', '.join(missing)}")
+                continue
+            if measure and target not in graph.forward.get(source, {}):
+                growth += len(_dumps({"source": source, "target": target, "type": relation}))
+            graph.add(source, target, relation)
+            linked.append(f"  • {source} -[{relation}]-> {target}")
 
-        # Record state history
-        context["state_history"].append({
+        # Record state history (with a checkpoint of the freshly declared values)
+        growth += context["state_history"].append({
             "action": "declare",
-            "timestamp": now,
+            "timestamp": now_ms,
             "entities_declared": len(declared),
+            "entities": declared_names,
+            "relationships_declared": len(linked),
             "errors": len(errors),
-        })
+        }, context["declared_entities"], checkpoint=True, measure=measure)
+        self._reasoning_contexts.resize(user_id, growth)
 
-        if __event_emitter__:
-            status_msg = f"Declared {len(declared)} entities"
-            if errors:
-                status_msg += f" ({len(errors)} errors)"
-            await __event_emitter__({
-                "type": "status",
-                "data": {
-                    "status": "declared",
-                    "description": status_msg,
-                    "done": True
-                }
-            })
+        # Look up related memories concurrently with persisting the context.
+        # Nothing above yields to the event loop, so starting here loses no overlap.
+        recall_task = None
+        user_valves = __user__.get("valves")
+        if getattr(user_valves, "AUTO_RECALL_ON_START", True) if user_valves else True:
+            entity_names = [entity["name"] for entity in entities if isinstance(entity, dict) and entity.get("name")]
+            recall_task = asyncio.create_task(self._recall_for_task(user_id, task_description, entity_names))
+
+        try:
+            await self._mark_context_dirty(user_id, declared_names)
+
+            if __event_emitter__:
+                status_msg = f"Declared {len(declared)} entities"
+                if errors:
+                    status_msg += f" ({len(errors)} errors)"
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "status": "declared",
+                        "description": status_msg,
+                        "done": True
+                    }
+                })
+        except BaseException:
+            # Don't leave the lookup running when the declaration fails
+            if recall_task is not None:
+                recall_task.cancel()
+            raise
 
         # Format response
         result_lines = [
@@ -235,12 +2309,28 @@ class Tools:
             f"**Declared Entities ({len(declared)}):**",
         ]
         result_lines.extend(declared)
+        if linked:
+            result_lines.append(f"**Relationships ({len(linked)}):**")
+            result_lines.extend(linked)
         
         if errors:
             result_lines.append(f"\n**⚠️ Declaration Errors ({len(errors)}):**")
             for err in errors:
                 result_lines.append(f"  • {err}")
         
+        if recall_task is not None:
+            try:
+                recalled = await recall_task
+            except Exception:
+                # Recall is best effort and must not fail the declaration
+                recalled = []
+            if recalled:
+                show_ids = getattr(user_valves, "SHOW_MEMORY_IDS", False) if user_valves else False
+                result_lines.append(f"\n**📚 Related Memories ({len(recalled)}):**")
+                for memory in recalled:
+                    content = memory.content if len(memory.content) <= 150 else memory.content[:147] + "..."
+                    result_lines.append(f"  • [{memory.id}] {content}" if show_ids else f"  • {content}")
+        
         result_lines.append(f"\n✅ Context ready. You may now proceed with reasoning.")
         result_lines.append(f"💡 Use `update_entity` to modify values, `validate_context` to check state.")
         
@@ -249,6 +2339,7 @@ class Tools:
     async def validate_context(
         self,
         entity_names: Optional[List[str]] = None,
+        changes_only: bool = False,
         __user__: Optional[dict] = None,
         __event_emitter__: Optional[Callable[[dict], Any]] = None,
     ) -> str:
@@ -257,16 +2348,18 @@ class Tools:
         Call this before using entities in your reasoning to catch undefined references early.
 
         If entity_names is provided, validates only those specific entities.
-        If entity_names is None, returns the full context state.
+        If entity_names is None, returns the full context state (or, with changes_only,
+        only the entities declared or modified since the previous validation).
 
         :param entity_names: Optional list of entity names to validate (None = show all)
+        :param changes_only: If true, list only entities changed since the last validation
         :return: Validation result with current state of entities
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         user_id = __user__.get("id", "anonymous")
-        context = self._get_user_context(user_id)
+        context = await self._get_user_context(user_id)
         
         if __event_emitter__:
             await __event_emitter__({
@@ -279,8 +2372,14 @@ class Tools:
             })
 
         declared = context.get("declared_entities", {})
-        now = datetime.now().isoformat()
-        context["last_validated"] = now
+        previous_validation = context.get("last_validated")
+        # Changes are compared by history sequence, which (unlike the clock) always moves forward
+        validated_seq = context.get("validated_seq", 0)
+        now_ms = _now_ms()
+        now = _format_ms(now_ms)
+        context["last_validated"] = now_ms
+        context["validated_seq"] = context["state_history"].seq
+        await self._mark_context_dirty(user_id)
         
         if not declared:
             if __event_emitter__:
@@ -305,7 +2404,7 @@ class Tools:
             for name in entity_names:
                 if name in declared:
                     entity = declared[name]
-                    valid.append(f"  ✅ {name}: {entity['type']} = {json.dumps(entity['value'])}")
+                    valid.append(f"  ✅ {name}: {entity.type} = {entity.value_json()}")
                 else:
                     undefined.append(f"  ❌ {name}: UNDEFINED")
             
@@ -343,22 +2442,28 @@ class Tools:
                     + "\n".join(valid)
                 )
         else:
-            # Show full context
+            # Show full context (or only what changed since the previous validation)
             lines = [
                 f"## Current Reasoning Context",
                 f"**Task:** {context.get('task_description', 'Not specified')}",
                 f"**Declared at:** {context.get('declaration_time', 'N/A')}",
                 f"**Last validated:** {now}",
-                f"\n**Declared Entities ({len(declared)}):**"
             ]
+
+            if changes_only:
+                changed = [(name, entity) for name, entity in declared.items() if entity.changed_seq >= validated_seq]
+                lines.append(
+                    f"\n**Changed since {_format_ms(previous_validation) if previous_validation else 'declaration'} "
+                    f"({len(changed)} of {len(declared)}):**"
+                )
+                if not changed:
+                    lines.append("  No entities changed.")
+            else:
+                changed = declared.items()
+                lines.append(f"\n**Declared Entities ({len(declared)}):**")
             
-            for name, entity in declared.items():
-                value_str = json.dumps(entity['value']) if entity['value'] is not None else "null"
-                if len(value_str) > 50:
-                    value_str = value_str[:47] + "..."
-                lines.append(f"  • {name} ({entity['type']}): {value_str}")
-                if entity.get('description'):
-                    lines.append(f"    _{entity['description']}_")
+            # Lines are cached per entity and only re-rendered after a change
+            lines.extend(entity.render_line(name) for name, entity in changed)
             
             if __event_emitter__:
                 await __event_emitter__({
@@ -390,10 +2495,10 @@ class Tools:
         :return: Confirmation of update with old and new values
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         user_id = __user__.get("id", "anonymous")
-        context = self._get_user_context(user_id)
+        context = await self._get_user_context(user_id)
         declared = context.get("declared_entities", {})
         
         if entity_name not in declared:
@@ -405,50 +2510,288 @@ class Tools:
                 f"Call `declare_reasoning_context` to declare new entities."
             )
 
-        entity = declared[entity_name]
-        old_value = entity["value"]
-        now = datetime.now().isoformat()
-        
-        # Update the entity
-        entity["value"] = new_value
-        entity["last_modified"] = now
-        entity["modification_count"] = entity.get("modification_count", 0) + 1
-        
-        # Record in state history
-        context["state_history"].append({
-            "action": "update",
-            "entity": entity_name,
-            "old_value": old_value,
-            "new_value": new_value,
-            "timestamp": now,
-        })
+        entity = declared[entity_name]
+        old_value = entity.value
+        old_str = entity.value_json()
+        now_ms = _now_ms()
+        
+        # Update the entity (copied so the caller cannot mutate stored state)
+        new_value = copy.deepcopy(new_value)
+        entity.value = new_value
+        entity.last_modified = now_ms
+        entity.modification_count += 1
+        entity.changed_seq = context["state_history"].seq
+        
+        # Record in state history as a patch against the previous value
+        measure = self.valves.CONTEXT_MAX_BYTES > 0
+        growth = context["state_history"].append({
+            "action": "update",
+            "entity": entity_name,
+            "version": entity.modification_count,
+            "patch": _make_patch(old_value, new_value),
+            "timestamp": now_ms,
+        }, declared, measure=measure)
+        if measure:
+            self._reasoning_contexts.resize(user_id, growth + len(entity.value_json()) - len(old_str))
+        await self._mark_context_dirty(user_id, [entity_name])
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "updated",
+                    "description": f"Entity '{entity_name}' updated.",
+                    "done": True
+                }
+            })
+
+        new_str = entity.value_json()
+        
+        # Truncate long values for display
+        if len(old_str) > 50:
+            old_str = old_str[:47] + "..."
+        if len(new_str) > 50:
+            new_str = new_str[:47] + "..."
+        
+        return (
+            f"✅ **Entity Updated**\n"
+            f"**{entity_name}** ({entity.type})\n"
+            f"  Old: {old_str}\n"
+            f"  New: {new_str}\n"
+            f"  Modifications: {entity.modification_count}"
+        )
+
+    async def update_entities(
+        self,
+        updates: List[Dict],
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Update several previously declared entities at once.
+        Use this instead of repeated update_entity calls when one step changes
+        multiple values (e.g. positions, sizes and colors of a layout).
+
+        The update is atomic: if any name is not declared, nothing is changed.
+
+        Example updates:
+        [
+            {"name": "header_text", "value": {"content": "Title", "fontSize": 28}},
+            {"name": "primary_color", "value": "#0D47A1"}
+        ]
+
+        :param updates: List of {"name": "...", "value": <new_value>} pairs
+        :return: Compact summary of all applied changes
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        user_id = __user__.get("id", "anonymous")
+        context = await self._get_user_context(user_id)
+        declared = context.get("declared_entities", {})
+
+        if not updates:
+            return _dumps({"error": "No updates provided."})
+
+        # Validate everything before changing anything (later duplicates win)
+        pending: Dict[str, Any] = {}
+        malformed = []
+        for idx, update in enumerate(updates, 1):
+            if not isinstance(update, dict) or not update.get("name") or "value" not in update:
+                malformed.append(f"#{idx}")
+                continue
+            pending[update["name"]] = update["value"]
+        undefined = [name for name in pending if name not in declared]
+
+        if malformed or undefined:
+            lines = ["❌ **No entities updated.**\n"]
+            if undefined:
+                lines.append(f"Undeclared entities: {', '.join(undefined)}")
+            if malformed:
+                lines.append(f"Malformed updates (need name and value): {', '.join(malformed)}")
+            lines.append("\nDeclare missing entities with `declare_reasoning_context`, then retry the whole batch.")
+            return "\n".join(lines)
+
+        now_ms = _now_ms()
+        changes = []
+        summary = []
+        measure = self.valves.CONTEXT_MAX_BYTES > 0
+        growth = 0
+        for name, new_value in pending.items():
+            entity = declared[name]
+            old_value = entity.value
+            if measure:
+                growth -= len(entity.value_json())
+            # Copied so the caller cannot mutate stored state
+            new_value = copy.deepcopy(new_value)
+            entity.value = new_value
+            entity.last_modified = now_ms
+            entity.modification_count += 1
+            entity.changed_seq = context["state_history"].seq
+            changes.append({
+                "entity": name,
+                "version": entity.modification_count,
+                "patch": _make_patch(old_value, new_value),
+            })
+            new_str = entity.value_json()
+            growth += len(new_str)
+            if len(new_str) > 50:
+                new_str = new_str[:47] + "..."
+            summary.append(f"  • {name} = {new_str} (v{entity.modification_count})")
+
+        # One history record for the whole batch
+        growth += context["state_history"].append({
+            "action": "update_many",
+            "changes": changes,
+            "timestamp": now_ms,
+        }, declared, measure=measure)
+        self._reasoning_contexts.resize(user_id, growth)
+        await self._mark_context_dirty(user_id, list(pending))
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "updated",
+                    "description": f"{len(pending)} entities updated.",
+                    "done": True
+                }
+            })
+
+        return f"✅ **Entities Updated ({len(pending)})**\n" + "\n".join(summary)
+
+    async def get_entity_history(
+        self,
+        entity_name: str,
+        version: Optional[int] = None,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Show the change history of a declared entity, or its value at a past version.
+        Use this to inspect or roll back earlier states during your reasoning.
+
+        Version 0 is the declared value; each update_entity call adds one version.
+        Only recent history is retained.
+
+        :param entity_name: Name of the entity to inspect
+        :param version: Optional version number to materialize (None = list retained versions)
+        :return: Version list or the entity's value at the requested version
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        user_id = __user__.get("id", "anonymous")
+        context = await self._get_user_context(user_id)
+        declared = context.get("declared_entities", {})
+
+        if entity_name not in declared:
+            return f"❌ **Entity '{entity_name}' is not declared.**"
+
+        entity = declared[entity_name]
+        history = context["state_history"]
+
+        if version is not None:
+            if version == entity.modification_count:
+                found, value = True, entity.value
+            else:
+                found, value = history.materialize(entity_name, version)
+            if not found:
+                return f"❌ Version {version} of '{entity_name}' is not available (no longer retained or never existed)."
+            return (
+                f"**{entity_name}** ({entity.type}) at version {version}:\n"
+                f"{_dumps(value)}"
+            )
+
+        lines = [f"## History of {entity_name} (current version {entity.modification_count})"]
+        for entry_version, record, change in history.entity_versions(entity_name):
+            if change is None:
+                lines.append(f"  • v0 declared at {_format_ms(record['timestamp'])}")
+            else:
+                paths = ", ".join("/".join(str(key) for key in op["path"]) or "<value>" for op in change["patch"])
+                lines.append(f"  • v{entry_version} at {_format_ms(record['timestamp'])}: changed {paths or 'nothing'}")
+        if len(lines) == 1:
+            lines.append("  No retained history.")
+        lines.append("\n💡 Pass `version` to see the entity's value at that point.")
+        return "\n".join(lines)
+
+    async def get_related_entities(
+        self,
+        entity_name: str,
+        direction: str = "outgoing",
+        relation: Optional[str] = None,
+        depth: int = 1,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        List the entities related to one entity, instead of dumping the whole context.
+
+        "outgoing" follows relationships declared from this entity (e.g. children of
+        board via "contains"); "incoming" follows relationships pointing at it (e.g.
+        everything that depends on primary_color via "depends_on").
+
+        :param entity_name: Name of the entity to start from
+        :param direction: "outgoing" or "incoming"
+        :param relation: Optional relationship type to follow (None = all types)
+        :param depth: How many hops to follow (1 = direct neighbours only)
+        :return: Related entities with their current values
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+        if direction not in ("outgoing", "incoming"):
+            return _dumps({"error": f"Unknown direction '{direction}'. Use 'outgoing' or 'incoming'."})
+
+        user_id = __user__.get("id", "anonymous")
+        context = await self._get_user_context(user_id)
+        declared = context.get("declared_entities", {})
+
+        if entity_name not in declared:
+            return f"❌ **Entity '{entity_name}' is not declared.**"
+
+        incoming = direction == "incoming"
+        related = context["relationships"].traverse(entity_name, incoming, relation, depth)
+        label = f"{direction} '{relation}'" if relation else direction
+        if not related:
+            return f"No {label} relationships for '{entity_name}'."
+
+        lines = [f"## Entities related to {entity_name} ({label}, depth {max(1, depth)})"]
+        for name, rel, distance, via in related:
+            edge = f"{via} <-[{rel}]- {name}" if incoming else f"{via} -[{rel}]-> {name}"
+            entity = declared.get(name)
+            lines.append(f"  {edge}" + (f" (hop {distance})" if distance > 1 else ""))
+            if entity is not None:
+                lines.append("  " + entity.render_line(name))
+            else:
+                lines.append(f"    ⚠️ {name} is no longer declared")
+        return "\n".join(lines)
+
+    async def find_relationship_cycles(
+        self,
+        relation: Optional[str] = None,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Detect circular relationships (e.g. a depends_on b depends_on a) in the current context.
+
+        :param relation: Optional relationship type to check (None = all types)
+        :return: The cycles found, or confirmation that there are none
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
 
-        if __event_emitter__:
-            await __event_emitter__({
-                "type": "status",
-                "data": {
-                    "status": "updated",
-                    "description": f"Entity '{entity_name}' updated.",
-                    "done": True
-                }
-            })
+        user_id = __user__.get("id", "anonymous")
+        context = await self._get_user_context(user_id)
+        cycles = context["relationships"].find_cycles(relation)
 
-        old_str = json.dumps(old_value) if old_value is not None else "null"
-        new_str = json.dumps(new_value) if new_value is not None else "null"
-        
-        # Truncate long values for display
-        if len(old_str) > 50:
-            old_str = old_str[:47] + "..."
-        if len(new_str) > 50:
-            new_str = new_str[:47] + "..."
-        
-        return (
-            f"✅ **Entity Updated**\n"
-            f"**{entity_name}** ({entity['type']})\n"
-            f"  Old: {old_str}\n"
-            f"  New: {new_str}\n"
-            f"  Modifications: {entity['modification_count']}"
-        )
+        label = f"'{relation}' relationships" if relation else "relationships"
+        if not cycles:
+            return f"✅ No cycles found in {label}."
+        lines = [f"⚠️ **Found {len(cycles)} cycle(s) in {label}:**"]
+        for cycle in cycles:
+            lines.append("  • " + " -> ".join(cycle))
+        return "\n".join(lines)
 
     async def clear_context(
         self,
@@ -462,13 +2805,31 @@ class Tools:
         :return: Confirmation that context was cleared
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         user_id = __user__.get("id", "anonymous")
         
-        if user_id in self._reasoning_contexts:
-            previous_entities = len(self._reasoning_contexts[user_id].get("declared_entities", {}))
-            del self._reasoning_contexts[user_id]
+        previous_context = self._reasoning_contexts.pop(user_id) or self._evicted_contexts.pop(user_id, None)
+        self._dirty_contexts.pop(user_id, None)
+        # A flush already writing this user's context would land after the delete
+        # and bring it back; wait for it, then drop anything it re-queued on failure
+        if self._context_flushes_in_flight:
+            await asyncio.wait(list(self._context_flushes_in_flight))
+            self._dirty_contexts.pop(user_id, None)
+            self._evicted_contexts.pop(user_id, None)
+        backend = self._get_context_backend()
+        try:
+            if previous_context is None and backend is not None:
+                record = await self._run_db(backend.load, user_id)
+                if record is not None:
+                    previous_context = self._context_from_record(*record)
+            if backend is not None:
+                await self._run_db(backend.delete, user_id)
+        except Exception as e:
+            return _dumps({"error": f"Failed to clear the stored context: {str(e)}"})
+
+        if previous_context is not None:
+            previous_entities = len(previous_context.get("declared_entities", {}))
         else:
             previous_entities = 0
 
@@ -492,6 +2853,8 @@ class Tools:
         self,
         query: str,
         count: int = 5,
+        mode: Optional[str] = None,
+        max_tokens: Optional[int] = None,
         __user__: Optional[dict] = None,
         __event_emitter__: Optional[Callable[[dict], Any]] = None,
     ) -> str:
@@ -501,26 +2864,43 @@ class Tools:
 
         This wraps Open WebUI's native memory search with enhanced formatting.
 
-        :param query: Search query to find related memories
+        The query may include filters, applied before ranking:
+        category:preference (repeatable), after:2026-01-01, before:2026-02-01,
+        and "quoted phrases" that must appear verbatim.
+
+        :param query: Search query to find related memories (may include filters)
         :param count: Maximum number of memories to return (default: 5, max: 20)
+        :param mode: Optional search mode: "lexical" (keyword match), "vector" (semantic similarity) or "hybrid" (both combined). Defaults to the tool setting.
+        :param max_tokens: Optional approximate token budget for the listed memories; the best matches are kept in full, others shortened to a summary or left out
         :return: List of matching memories with their content
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available. Ensure Open WebUI's Memories module is accessible."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available. Ensure Open WebUI's Memories module is accessible."})
 
         if not self.valves.ENABLE_MEMORY_OPS:
-            return json.dumps({"error": "Memory operations are disabled in tool configuration."}, ensure_ascii=False)
+            return _dumps({"error": "Memory operations are disabled in tool configuration."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
 
         # Clamp count to reasonable limits
         count = min(max(1, count), min(20, self.valves.MAX_MEMORIES_PER_SEARCH))
 
+        mode = (mode or self.valves.SEARCH_MODE).lower()
+        if mode not in ("lexical", "vector", "hybrid"):
+            return _dumps({"error": f"Unknown search mode '{mode}'. Use 'lexical', 'vector' or 'hybrid'."})
+        if mode != "lexical" and not NUMPY_AVAILABLE:
+            return _dumps({"error": f"The '{mode}' search mode requires numpy, which is not installed."})
+
+        try:
+            search = _SearchQuery(query)
+        except ValueError as e:
+            return _dumps({"error": str(e)})
+
         if __event_emitter__:
             await __event_emitter__({
                 "type": "status",
@@ -532,12 +2912,13 @@ class Tools:
             })
 
         try:
-            # Get all user memories and filter by query
+            # Look up memories through the user's cached bank and its indexes
             # Note: Open WebUI's native search_memories uses vector similarity
-            # Here we're doing a simpler text-based search as fallback
-            user_memories = Memories.get_memories_by_user_id(user_id)
+            # backed by a remote embedding model; "vector" mode here uses a
+            # local offline embedder instead
+            snapshot = await self._get_memory_snapshot(user_id)
             
-            if not user_memories:
+            if not snapshot.memories:
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
@@ -549,27 +2930,7 @@ class Tools:
                     })
                 return "No memories found. Use `add_memory_enhanced` to store new facts."
 
-            # Simple relevance scoring based on query term matching
-            query_terms = query.lower().split()
-            scored_memories = []
-            
-            for memory in user_memories:
-                content_lower = memory.content.lower()
-                score = sum(1 for term in query_terms if term in content_lower)
-                if score > 0:
-                    scored_memories.append((score, memory))
-
-            # Sort by score (descending) and take top results
-            scored_memories.sort(key=lambda x: x[0], reverse=True)
-            results = scored_memories[:count]
-
-            if not results:
-                # Fallback: return most recent memories if no matches
-                sorted_memories = sorted(user_memories, key=lambda m: m.created_at, reverse=True)
-                results = [(0, m) for m in sorted_memories[:count]]
-                fallback_msg = "(No exact matches, showing recent memories)"
-            else:
-                fallback_msg = ""
+            results, fallback_msg = await self._cached_search(user_id, snapshot, search, mode, count)
 
             # Check user preference for showing IDs
             show_ids = False
@@ -578,21 +2939,42 @@ class Tools:
                 if user_valves:
                     show_ids = getattr(user_valves, "SHOW_MEMORY_IDS", False)
 
+            if max_tokens is not None:
+                # Best matches first, in full or as a summary, within the budget
+                overhead = _estimate_tokens(f"20. [{'0' * 32}] " if show_ids else "20. ")
+                entries = [(memory.content, _summarize_memory(memory.content)) for _, memory in results]
+                packed = [
+                    (results[position][1], content)
+                    for position, content in _pack_to_budget(entries, max(0, max_tokens), overhead)
+                ]
+                summarized = sum(1 for memory, content in packed if content != memory.content)
+            else:
+                packed = [
+                    (memory, memory.content if len(memory.content) <= 200 else memory.content[:197] + "...")
+                    for _, memory in results
+                ]
+                summarized = 0
+
             # Format results
             lines = [f"## Memory Search Results{' ' + fallback_msg if fallback_msg else ''}"]
             lines.append(f"**Query:** {query}")
-            lines.append(f"**Found:** {len(results)} memories\n")
+            if len(packed) < len(results):
+                lines.append(f"**Found:** {len(results)} memories, {len(packed)} shown\n")
+            else:
+                lines.append(f"**Found:** {len(results)} memories\n")
 
-            for idx, (score, memory) in enumerate(results, 1):
-                content = memory.content
-                if len(content) > 200:
-                    content = content[:197] + "..."
-                
+            for idx, (memory, content) in enumerate(packed, 1):
                 if show_ids:
                     lines.append(f"{idx}. [{memory.id}] {content}")
                 else:
                     lines.append(f"{idx}. {content}")
 
+            if len(packed) < len(results) or summarized:
+                lines.append(
+                    f"\n_To fit max_tokens={max_tokens}: {summarized} shortened to a summary, "
+                    f"{len(results) - len(packed)} left out._"
+                )
+
             if __event_emitter__:
                 await __event_emitter__({
                     "type": "status",
@@ -615,7 +2997,7 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Memory search failed: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Memory search failed: {str(e)}"})
 
     async def add_memory_enhanced(
         self,
@@ -639,30 +3021,24 @@ class Tools:
         :return: Confirmation that the memory was stored
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available."})
 
         if not self.valves.ENABLE_MEMORY_OPS:
-            return json.dumps({"error": "Memory operations are disabled."}, ensure_ascii=False)
+            return _dumps({"error": "Memory operations are disabled."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
 
         # Validate content
         if not content or len(content.strip()) < 3:
-            return json.dumps({"error": "Memory content too short. Provide meaningful information."}, ensure_ascii=False)
+            return _dumps({"error": "Memory content too short. Provide meaningful information."})
 
-        if len(content) > 1000:
-            content = content[:1000]  # Truncate to reasonable length
-
-        # Add category prefix if provided
-        if category:
-            formatted_content = f"[{category.upper()}] {content}"
-        else:
-            formatted_content = content
+        # Truncate to reasonable length and add category prefix if provided
+        formatted_content = _format_memory_content(content, category)
 
         if __event_emitter__:
             await __event_emitter__({
@@ -675,19 +3051,33 @@ class Tools:
             })
 
         try:
-            new_memory = Memories.insert_new_memory(user_id, formatted_content)
+            new_memory, action = await self._store_memory(user_id, formatted_content)
             
             if new_memory:
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
                         "data": {
-                            "status": "stored",
-                            "description": "Memory stored successfully.",
+                            "status": action,
+                            "description": "Memory stored successfully." if action == "stored"
+                            else f"Near-duplicate memory {action}.",
                             "done": True
                         }
                     })
                 
+                if action != "stored":
+                    preview = new_memory.content[:80] + "..." if len(new_memory.content) > 80 else new_memory.content
+                    heading = (
+                        "⚠️ **Near-duplicate Not Stored**" if action == "rejected"
+                        else f"✅ **Existing Memory {action.capitalize()}** (near-duplicate)"
+                    )
+                    return (
+                        f"{heading}\n"
+                        f"**Content:** {preview}\n"
+                        f"**Memory ID:** {new_memory.id}\n\n"
+                        f"Use `update_memory` to change it, or `delete_memory` to remove it."
+                    )
+                
                 preview = formatted_content[:80] + "..." if len(formatted_content) > 80 else formatted_content
                 return (
                     f"✅ **Memory Stored**\n"
@@ -705,7 +3095,7 @@ class Tools:
                             "done": True
                         }
                     })
-                return json.dumps({"error": "Failed to store memory."}, ensure_ascii=False)
+                return _dumps({"error": "Failed to store memory."})
 
         except Exception as e:
             if __event_emitter__:
@@ -717,7 +3107,111 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Memory storage failed: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Memory storage failed: {str(e)}"})
+
+    async def add_memories_bulk(
+        self,
+        items: List[Dict],
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Store many facts in the user's personal memory bank with a single call.
+        Prefer this over repeated add_memory_enhanced calls when saving several facts,
+        e.g. at the end of a large design task.
+
+        Item structure:
+        {"content": "The fact to remember", "category": "preference|project|skill|..."}
+
+        Items are validated together; invalid items are reported and skipped while
+        the valid ones are stored in batched database transactions.
+
+        :param items: List of memories to store, each with "content" and an optional "category"
+        :return: Compact summary of stored and rejected items
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        if not MEMORIES_AVAILABLE:
+            return _dumps({"error": "Memory system not available."})
+
+        if not self.valves.ENABLE_MEMORY_OPS:
+            return _dumps({"error": "Memory operations are disabled."})
+
+        user_id = __user__.get("id")
+        if not user_id:
+            return _dumps({"error": "User ID not found."})
+
+        if not items:
+            return _dumps({"error": "No items provided."})
+
+        if len(items) > self.valves.MAX_BULK_ITEMS:
+            return _dumps({"error": f"Too many items ({len(items)}). Maximum per call is {self.valves.MAX_BULK_ITEMS}."})
+
+        # Validate all items in one pass
+        contents = []
+        rejected = []
+        for idx, item in enumerate(items, 1):
+            content = item.get("content") if isinstance(item, dict) else None
+            if not isinstance(content, str) or len(content.strip()) < 3:
+                rejected.append(f"  • #{idx}: content missing or too short")
+                continue
+            contents.append(_format_memory_content(content, item.get("category")))
+
+        stored = []
+        batch_size = max(1, self.valves.BULK_BATCH_SIZE)
+
+        try:
+            for start in range(0, len(contents), batch_size):
+                if __event_emitter__:
+                    await __event_emitter__({
+                        "type": "status",
+                        "data": {
+                            "status": "storing",
+                            "description": f"Storing memories {start + 1}-{min(start + batch_size, len(contents))} of {len(contents)}...",
+                            "done": False
+                        }
+                    })
+                batch = await self._run_db(_insert_memory_batch, user_id, contents[start:start + batch_size])
+                for memory in batch:
+                    self._record_memory_write(user_id, memory)
+                stored.extend(batch)
+
+        except Exception as e:
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "status": "error",
+                        "description": f"Bulk storage failed after {len(stored)} memories: {str(e)}",
+                        "done": True
+                    }
+                })
+            return _dumps({
+                "error": f"Bulk memory storage failed: {str(e)}",
+                "stored_ids": [memory.id for memory in stored],
+            })
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "stored",
+                    "description": f"Stored {len(stored)} of {len(items)} memories.",
+                    "done": True
+                }
+            })
+
+        lines = [
+            f"✅ **Bulk Memory Store**",
+            f"**Stored:** {len(stored)}/{len(items)}",
+        ]
+        if stored:
+            lines.append(f"**Memory IDs:** {', '.join(memory.id for memory in stored)}")
+        if rejected:
+            lines.append(f"\n**⚠️ Rejected ({len(rejected)}):**")
+            lines.extend(rejected)
+        return "\n".join(lines)
 
     async def update_memory(
         self,
@@ -738,20 +3232,20 @@ class Tools:
         :return: Confirmation of the update
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available."})
 
         if not self.valves.ENABLE_MEMORY_OPS:
-            return json.dumps({"error": "Memory operations are disabled."}, ensure_ascii=False)
+            return _dumps({"error": "Memory operations are disabled."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
 
         if not new_content or len(new_content.strip()) < 3:
-            return json.dumps({"error": "Memory content too short."}, ensure_ascii=False)
+            return _dumps({"error": "Memory content too short."})
 
         if __event_emitter__:
             await __event_emitter__({
@@ -764,9 +3258,10 @@ class Tools:
             })
 
         try:
-            updated_memory = Memories.update_memory_by_id(memory_id, new_content)
+            updated_memory = await self._run_db(Memories.update_memory_by_id, memory_id, new_content)
             
             if updated_memory:
+                self._record_memory_write(user_id, updated_memory)
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
@@ -789,7 +3284,7 @@ class Tools:
                             "done": True
                         }
                     })
-                return json.dumps({"error": f"Memory with ID '{memory_id}' not found."}, ensure_ascii=False)
+                return _dumps({"error": f"Memory with ID '{memory_id}' not found."})
 
         except Exception as e:
             if __event_emitter__:
@@ -801,7 +3296,7 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Memory update failed: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Memory update failed: {str(e)}"})
 
     async def delete_memory(
         self,
@@ -817,17 +3312,17 @@ class Tools:
         :return: Confirmation of the deletion
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available."})
 
         if not self.valves.ENABLE_MEMORY_OPS:
-            return json.dumps({"error": "Memory operations are disabled."}, ensure_ascii=False)
+            return _dumps({"error": "Memory operations are disabled."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
 
         if __event_emitter__:
             await __event_emitter__({
@@ -840,9 +3335,10 @@ class Tools:
             })
 
         try:
-            result = Memories.delete_memory_by_id(memory_id)
+            result = await self._run_db(Memories.delete_memory_by_id, memory_id)
             
             if result:
+                self._record_memory_delete(user_id, memory_id)
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
@@ -863,7 +3359,7 @@ class Tools:
                             "done": True
                         }
                     })
-                return json.dumps({"error": f"Memory with ID '{memory_id}' not found or already deleted."}, ensure_ascii=False)
+                return _dumps({"error": f"Memory with ID '{memory_id}' not found or already deleted."})
 
         except Exception as e:
             if __event_emitter__:
@@ -875,45 +3371,276 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Memory deletion failed: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Memory deletion failed: {str(e)}"})
+
+    async def update_memories_bulk(
+        self,
+        updates: Optional[List[Dict]] = None,
+        category: Optional[str] = None,
+        created_before: Optional[str] = None,
+        new_category: Optional[str] = None,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Update many memories with a single call.
+
+        Either pass explicit updates as a list of {"id": "...", "content": "..."},
+        or select memories with a filter (category and/or created_before) and
+        re-tag all of them with new_category.
+
+        :param updates: Optional list of {"id", "content"} pairs to apply
+        :param category: Optional filter: only memories tagged with this category (e.g. "context", "preference")
+        :param created_before: Optional filter: only memories created before this ISO date (e.g. "2026-01-31")
+        :param new_category: Category tag to apply to the filtered memories
+        :return: Compact summary of updated and missing memory IDs
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        if not MEMORIES_AVAILABLE:
+            return _dumps({"error": "Memory system not available."})
+
+        if not self.valves.ENABLE_MEMORY_OPS:
+            return _dumps({"error": "Memory operations are disabled."})
+
+        user_id = __user__.get("id")
+        if not user_id:
+            return _dumps({"error": "User ID not found."})
+
+        changes: Dict[str, str] = {}
+        rejected = []
+        if updates:
+            for idx, update in enumerate(updates, 1):
+                memory_id = update.get("id") if isinstance(update, dict) else None
+                content = update.get("content") if isinstance(update, dict) else None
+                if not memory_id or not isinstance(content, str) or len(content.strip()) < 3:
+                    rejected.append(f"#{idx}")
+                    continue
+                changes[memory_id] = content[:_MAX_MEMORY_LENGTH]
+        elif category or created_before:
+            if not new_category:
+                return _dumps({"error": "new_category is required when updating by filter."})
+            try:
+                selected = await self._select_memories(user_id, category, created_before)
+            except ValueError:
+                return _dumps({"error": f"Invalid created_before date '{created_before}'. Use ISO format, e.g. 2026-01-31."})
+            for memory in selected:
+                changes[memory.id] = _format_memory_content(_CATEGORY_PATTERN.sub("", memory.content, count=1), new_category)
+        else:
+            return _dumps({"error": "Provide either updates or a filter (category and/or created_before)."})
+
+        if len(changes) > self.valves.MAX_BULK_ITEMS:
+            return _dumps({"error": f"Too many memories selected ({len(changes)}). Maximum per call is {self.valves.MAX_BULK_ITEMS}."})
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "updating",
+                    "description": f"Updating {len(changes)} memories...",
+                    "done": False
+                }
+            })
+
+        try:
+            updated = await self._run_db(_update_memory_batch, user_id, changes) if changes else {}
+            for memory in updated.values():
+                self._record_memory_write(user_id, memory)
+
+        except Exception as e:
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "status": "error",
+                        "description": f"Bulk update failed: {str(e)}",
+                        "done": True
+                    }
+                })
+            return _dumps({"error": f"Bulk memory update failed: {str(e)}"})
+
+        missing = [memory_id for memory_id in changes if memory_id not in updated]
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "updated",
+                    "description": f"Updated {len(updated)} of {len(changes)} memories.",
+                    "done": True
+                }
+            })
+
+        lines = [
+            f"✅ **Bulk Memory Update**",
+            f"**Updated:** {len(updated)}/{len(changes)}",
+        ]
+        if updated:
+            lines.append(f"**Updated IDs:** {', '.join(updated)}")
+        if missing:
+            lines.append(f"**Not found:** {', '.join(missing)}")
+        if rejected:
+            lines.append(f"**Rejected (missing id or content too short):** {', '.join(rejected)}")
+        return "\n".join(lines)
+
+    async def delete_memories_bulk(
+        self,
+        memory_ids: Optional[List[str]] = None,
+        category: Optional[str] = None,
+        created_before: Optional[str] = None,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Delete many memories with a single call.
+        Use this to clean up, e.g. removing all stale context snapshots at once.
+
+        Pass explicit memory_ids, a filter (category and/or created_before), or both
+        (then only the listed IDs that also match the filter are deleted).
+
+        :param memory_ids: Optional list of memory IDs to delete
+        :param category: Optional filter: only memories tagged with this category (e.g. "context", "preference")
+        :param created_before: Optional filter: only memories created before this ISO date (e.g. "2026-01-31")
+        :return: Compact summary of deleted and missing memory IDs
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        if not MEMORIES_AVAILABLE:
+            return _dumps({"error": "Memory system not available."})
+
+        if not self.valves.ENABLE_MEMORY_OPS:
+            return _dumps({"error": "Memory operations are disabled."})
+
+        user_id = __user__.get("id")
+        if not user_id:
+            return _dumps({"error": "User ID not found."})
+
+        if not memory_ids and not category and not created_before:
+            return _dumps({"error": "Provide memory_ids and/or a filter (category, created_before)."})
+
+        targets = list(dict.fromkeys(memory_ids or []))
+        if category or created_before:
+            try:
+                selected = [memory.id for memory in await self._select_memories(user_id, category, created_before)]
+            except ValueError:
+                return _dumps({"error": f"Invalid created_before date '{created_before}'. Use ISO format, e.g. 2026-01-31."})
+            if memory_ids:
+                matching = set(selected)
+                targets = [memory_id for memory_id in targets if memory_id in matching]
+            else:
+                targets = selected
+
+        if len(targets) > self.valves.MAX_BULK_ITEMS:
+            return _dumps({"error": f"Too many memories selected ({len(targets)}). Maximum per call is {self.valves.MAX_BULK_ITEMS}."})
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "deleting",
+                    "description": f"Deleting {len(targets)} memories...",
+                    "done": False
+                }
+            })
+
+        try:
+            deleted = await self._run_db(_delete_memory_batch, user_id, targets) if targets else set()
+            for memory_id in deleted:
+                self._record_memory_delete(user_id, memory_id)
+
+        except Exception as e:
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "status": "error",
+                        "description": f"Bulk deletion failed: {str(e)}",
+                        "done": True
+                    }
+                })
+            return _dumps({"error": f"Bulk memory deletion failed: {str(e)}"})
+
+        missing = [memory_id for memory_id in targets if memory_id not in deleted]
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "deleted",
+                    "description": f"Deleted {len(deleted)} of {len(targets)} memories.",
+                    "done": True
+                }
+            })
+
+        lines = [
+            f"✅ **Bulk Memory Delete**",
+            f"**Deleted:** {len(deleted)}/{len(targets)}",
+        ]
+        if deleted:
+            lines.append(f"**Deleted IDs:** {', '.join(memory_id for memory_id in targets if memory_id in deleted)}")
+        if missing:
+            lines.append(f"**Not found:** {', '.join(missing)}")
+        return "\n".join(lines)
 
     async def recall_all_memories(
         self,
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        stream: bool = False,
+        max_tokens: Optional[int] = None,
         __user__: Optional[dict] = None,
         __event_emitter__: Optional[Callable[[dict], Any]] = None,
     ) -> str:
         """
-        Retrieve ALL stored memories from the user's memory bank.
+        Retrieve stored memories from the user's memory bank, oldest first, one page at a time.
         Use this to get a complete picture of what has been stored about the user.
 
-        Returns a numbered list of all memories with their IDs for easy reference.
+        Returns a numbered list of memories with their IDs for easy reference. If more
+        memories exist, the result ends with a cursor; pass it back to get the next page.
 
-        :return: Complete list of all stored memories
+        :param limit: Optional number of memories per page (defaults to and is capped by the tool setting)
+        :param cursor: Optional cursor from a previous page to continue after
+        :param stream: If true, show the page to the user progressively in the chat and return only a short summary
+        :param max_tokens: Optional approximate token budget for the page; memories that do not fit in full are summarized, and the page ends early once even a summary does not fit
+        :return: One page of stored memories and the cursor for the next page
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
+
+        page_size = max(1, self.valves.RECALL_PAGE_SIZE)
+        limit = min(max(1, limit), page_size) if limit else page_size
+
+        after = None
+        if cursor:
+            created_at, _, memory_id = cursor.partition(":")
+            try:
+                after = (float(created_at), memory_id)
+            except ValueError:
+                return _dumps({"error": f"Invalid cursor '{cursor}'."})
 
         if __event_emitter__:
             await __event_emitter__({
                 "type": "status",
                 "data": {
                     "status": "recalling",
-                    "description": "Retrieving all memories...",
+                    "description": "Retrieving memories...",
                     "done": False
                 }
             })
 
         try:
-            user_memories = Memories.get_memories_by_user_id(user_id)
+            snapshot = await self._get_memory_snapshot(user_id)
             
-            if not user_memories:
+            if not snapshot.memories:
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
@@ -925,28 +3652,57 @@ class Tools:
                     })
                 return "No memories stored yet. Use `add_memory_enhanced` to store new facts."
 
-            # Sort by creation date
-            sorted_memories = sorted(user_memories, key=lambda m: m.created_at)
+            # Page through the created_at-ordered timeline
+            offset, page = snapshot.page(after, limit)
+            total = len(snapshot.timeline)
+            contents = [memory.content for memory in page]
+            summarized = 0
+            if max_tokens is not None and page:
+                # Contiguous prefix of the page that fits the budget (at least one summary)
+                overhead = _estimate_tokens(f"{offset + len(page)}. **[{page[0].id}]** ")
+                entries = [(memory.content, _summarize_memory(memory.content)) for memory in page]
+                packed = _pack_to_budget(entries, max(0, max_tokens), overhead, stop_at_overflow=True)
+                if not packed:
+                    packed = [(0, entries[0][1])]
+                page = page[:len(packed)]
+                contents = [content for _, content in packed]
+                summarized = sum(1 for memory, content in zip(page, contents) if content != memory.content)
+            next_cursor = None
+            if page and offset + len(page) < total:
+                next_cursor = f"{page[-1].created_at}:{page[-1].id}"
             
             lines = [
                 "## All Stored Memories",
-                f"**Total:** {len(sorted_memories)} memories\n"
+                f"**Total:** {total} memories (showing {offset + 1 if page else offset}-{offset + len(page)})\n"
             ]
             
-            for idx, memory in enumerate(sorted_memories, 1):
+            for idx, (memory, content) in enumerate(zip(page, contents), offset + 1):
                 # Include ID for update/delete operations
-                lines.append(f"{idx}. **[{memory.id}]** {memory.content}")
+                lines.append(f"{idx}. **[{memory.id}]** {content}")
+            if summarized:
+                lines.append(f"\n_{summarized} memories shortened to a summary to fit max_tokens={max_tokens}._")
+
+            if stream and __event_emitter__:
+                # Show the page to the user in chunks and keep the tool result small
+                for start in range(0, len(lines), 10):
+                    await __event_emitter__({
+                        "type": "message",
+                        "data": {"content": "\n".join(lines[start:start + 10]) + "\n"}
+                    })
+                lines = [f"Streamed memories {offset + 1 if page else offset}-{offset + len(page)} of {total} to the chat."]
 
             if __event_emitter__:
                 await __event_emitter__({
                     "type": "status",
                     "data": {
                         "status": "recalled",
-                        "description": f"Retrieved {len(sorted_memories)} memories.",
+                        "description": f"Retrieved {len(page)} of {total} memories.",
                         "done": True
                     }
                 })
 
+            if next_cursor:
+                lines.append(f"\n**More memories available.** Call again with cursor=\"{next_cursor}\" for the next page.")
             lines.append("\n_Use memory IDs with `update_memory` or `delete_memory` to manage entries._")
             
             return "\n".join(lines)
@@ -961,7 +3717,7 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Memory recall failed: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Memory recall failed: {str(e)}"})
 
     # =========================================================================
     # COMMIT REASONING CONTEXT TO MEMORY
@@ -983,20 +3739,20 @@ class Tools:
         :return: Confirmation of what was saved to memory
         """
         if not __user__:
-            return json.dumps({"error": "User context not provided."}, ensure_ascii=False)
+            return _dumps({"error": "User context not provided."})
 
         if not MEMORIES_AVAILABLE:
-            return json.dumps({"error": "Memory system not available."}, ensure_ascii=False)
+            return _dumps({"error": "Memory system not available."})
 
         user_id = __user__.get("id")
         if not user_id:
-            return json.dumps({"error": "User ID not found."}, ensure_ascii=False)
+            return _dumps({"error": "User ID not found."})
 
-        context = self._get_user_context(user_id)
+        context = await self._get_user_context(user_id)
         declared = context.get("declared_entities", {})
         
         if not declared:
-            return json.dumps({"error": "No reasoning context to save. Declare entities first."}, ensure_ascii=False)
+            return _dumps({"error": "No reasoning context to save. Declare entities first."})
 
         if __event_emitter__:
             await __event_emitter__({
@@ -1012,7 +3768,7 @@ class Tools:
         if entities_to_save:
             to_save = {name: declared[name] for name in entities_to_save if name in declared}
         else:
-            to_save = {name: entity for name, entity in declared.items() if entity["value"] is not None}
+            to_save = {name: entity for name, entity in declared.items() if entity.value is not None}
 
         if not to_save:
             return "No entities with values to save."
@@ -1026,33 +3782,43 @@ class Tools:
         memory_content += "Entities:\n"
         
         for name, entity in to_save.items():
-            value_str = json.dumps(entity["value"])
+            value_str = entity.value_json()
             if len(value_str) > 100:
                 value_str = value_str[:97] + "..."
-            memory_content += f"  - {name} ({entity['type']}): {value_str}\n"
+            memory_content += f"  - {name} ({entity.type}): {value_str}\n"
 
         try:
-            new_memory = Memories.insert_new_memory(user_id, memory_content)
+            new_memory, action = await self._store_memory(user_id, memory_content)
             
             if new_memory:
+                if action != "rejected":
+                    self._schedule_consolidation(user_id)
                 if __event_emitter__:
                     await __event_emitter__({
                         "type": "status",
                         "data": {
-                            "status": "committed",
-                            "description": f"Saved {len(to_save)} entities to memory.",
+                            "status": "committed" if action == "stored" else action,
+                            "description": f"Saved {len(to_save)} entities to memory." if action == "stored"
+                            else f"Near-duplicate context memory {action}.",
                             "done": True
                         }
                     })
+                if action == "rejected":
+                    return (
+                        f"⚠️ **Context Not Committed**\n"
+                        f"A near-duplicate context memory already exists.\n"
+                        f"**Memory ID:** {new_memory.id}"
+                    )
                 return (
-                    f"✅ **Context Committed to Memory**\n"
+                    f"✅ **Context Committed to Memory**"
+                    + (f" (existing memory {action})" if action != "stored" else "") + "\n"
                     f"**Summary:** {summary}\n"
                     f"**Entities Saved:** {len(to_save)}\n"
                     f"**Memory ID:** {new_memory.id}\n\n"
                     f"Saved: {', '.join(to_save.keys())}"
                 )
             else:
-                return json.dumps({"error": "Failed to save context to memory."}, ensure_ascii=False)
+                return _dumps({"error": "Failed to save context to memory."})
 
         except Exception as e:
             if __event_emitter__:
@@ -1064,4 +3830,73 @@ class Tools:
                         "done": True
                     }
                 })
-            return json.dumps({"error": f"Failed to commit context: {str(e)}"}, ensure_ascii=False)
+            return _dumps({"error": f"Failed to commit context: {str(e)}"})
+
+    async def consolidate_context_memories(
+        self,
+        dry_run: bool = False,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Optional[Callable[[dict], Any]] = None,
+    ) -> str:
+        """
+        Compact superseded context snapshots saved by commit_context_to_memory.
+        Snapshots of the same task are merged, keeping the latest value of every entity.
+
+        :param dry_run: If true, only report what would be consolidated
+        :return: Summary of the consolidated groups and memory counts
+        """
+        if not __user__:
+            return _dumps({"error": "User context not provided."})
+
+        if not MEMORIES_AVAILABLE:
+            return _dumps({"error": "Memory system not available."})
+
+        if not self.valves.ENABLE_MEMORY_OPS:
+            return _dumps({"error": "Memory operations are disabled."})
+
+        user_id = __user__.get("id")
+        if not user_id:
+            return _dumps({"error": "User ID not found."})
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "consolidating",
+                    "description": "Consolidating context memories...",
+                    "done": False
+                }
+            })
+
+        try:
+            groups, before, after = await self._consolidate_user_contexts(user_id, dry_run)
+        except Exception as e:
+            if __event_emitter__:
+                await __event_emitter__({
+                    "type": "status",
+                    "data": {
+                        "status": "error",
+                        "description": f"Consolidation failed: {str(e)}",
+                        "done": True
+                    }
+                })
+            return _dumps({"error": f"Context consolidation failed: {str(e)}"})
+
+        if __event_emitter__:
+            await __event_emitter__({
+                "type": "status",
+                "data": {
+                    "status": "consolidated",
+                    "description": f"Consolidated {before} context memories into {after}.",
+                    "done": True
+                }
+            })
+
+        if not groups:
+            return "✅ Nothing to consolidate: no task's context memories can be compacted further."
+        verb = "Would Consolidate" if dry_run else "Consolidated"
+        return (
+            f"✅ **{verb} Context Memories**\n"
+            f"**Tasks:** {groups}\n"
+            f"**Memories:** {before} → {after}"
+        )